@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks parallel move search, showing how searches scale with processes
+"""
+
+import argparse
+import os
+import time
+
+from go.analysis import ParallelMCTS
+from go.models import GameState
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=19, help="board size")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="maximum processes"
+    )
+    parser.add_argument("--time", type=float, default=5.0, help="seconds per search")
+    parser.add_argument("--komi", type=float, default=7.5)
+    args = parser.parse_args()
+
+    game_state = GameState(args.size)
+    baseline = None
+    print("workers  playouts/s  speedup")
+    for workers in range(1, args.workers + 1):
+        with ParallelMCTS(komi=args.komi, workers=workers) as search:
+            # Starts the worker processes before timing
+            search.search(game_state, max_playouts=workers)
+
+            start = time.monotonic()
+            result = search.search(game_state, time_limit=args.time)
+            rate = result.playouts / (time.monotonic() - start)
+
+        baseline = baseline if baseline is not None else rate
+        print(f"{workers:7}  {rate:10.1f}  {rate / baseline:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
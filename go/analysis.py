@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+Monte Carlo tree search for suggesting moves and estimating win rates
+"""
+
+import math
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Tuple
+
+from .errors import IllegalMoveException
+from .models import Color, GameState, Position
+from .playout import Playout, ProcessPoolBase, diagonal_table, is_eye
+
+DEFAULT_EXPLORATION = 1.0
+DEFAULT_MAX_NODES = 100000
+
+# Visits of a move from the root, and the wins of the player making it
+MoveStats = namedtuple("MoveStats", "visits wins")
+# Result of a search. ``move`` is None for a pass, and ``moves``
+# holds the statistics of every move searched from the root
+AnalysisResult = namedtuple("AnalysisResult", "move win_rate playouts moves")
+
+
+class Node:
+    """
+    A position in the search, holding the statistics of each move from it,
+    from the point of view of the color to play
+    """
+
+    __slots__ = ("moves", "visits", "wins", "total_visits")
+
+    def __init__(self, moves: List[Optional[int]]):
+        self.moves = moves  # Indices into the board, or None for a pass
+        self.visits = [0] * len(moves)
+        self.wins = [0.0] * len(moves)
+        self.total_visits = 0
+
+    def select(self, exploration: float) -> int:
+        """
+        The index of the move to search next, by the UCT formula,
+        trying every move once first
+        """
+        log_total = math.log(self.total_visits) if self.total_visits else 0
+        best, best_value = 0, -1.0
+        for j, visits in enumerate(self.visits):
+            if not visits:
+                return j
+            value = self.wins[j] / visits + exploration * math.sqrt(log_total / visits)
+            if value > best_value:
+                best, best_value = j, value
+
+        return best
+
+
+class MCTS:
+    """
+    Monte Carlo tree search over GameState, with random playouts
+
+    Positions are stored in a transposition table keyed by their hash,
+    the color to play and the ko point, so statistics are shared between
+    transpositions, and kept between searches, so that searching the position
+    after the moves that were expected reuses the tree already built
+    """
+
+    def __init__(
+        self,
+        komi: float = 0,
+        exploration: float = DEFAULT_EXPLORATION,
+        max_nodes: int = DEFAULT_MAX_NODES,
+        rng: Optional[random.Random] = None,
+    ):
+        self.komi = komi
+        self.exploration = exploration
+        self.max_nodes = max_nodes
+        self.rng = rng if rng is not None else random.Random()
+        self.table: Dict[Tuple[int, int, Optional[Position]], Node] = {}
+
+    @staticmethod
+    def _key(game_state: GameState) -> Tuple[int, int, Optional[Position]]:
+        return (
+            game_state.position_hash,
+            game_state.current_color.value,
+            game_state.ko_point,
+        )
+
+    @staticmethod
+    def _is_over(game_state: GameState) -> bool:
+        # Whether the game has ended by both players passing
+        position = game_state.history_position
+        return position >= 2 and all(
+            entry.pos is None for entry in game_state.history[position - 2 : position]
+        )
+
+    def _expand(self, game_state: GameState) -> Node:
+        # Creates a node with every legal move that does not fill an eye,
+        # and passing
+        board = game_state.board
+        diagonals = diagonal_table(board.size)
+        color = game_state.current_color
+        moves = [
+            i
+            for i, legal in enumerate(game_state.legal_mask())
+            if legal
+            and not is_eye(board, diagonals, i, color.value)
+            and game_state.is_legal(board.position(i))
+        ]
+        moves += [None]
+        # Unvisited moves are tried in order, so the order is randomised
+        self.rng.shuffle(moves)
+        return Node(moves)
+
+    def _iterate(self, game_state: GameState):
+        # Runs one iteration of the search from the given position:
+        # selects moves down the tree, expands a new node,
+        # evaluates it with a playout, or scores it if the game has ended,
+        # and updates the statistics along the path
+        path = []
+        played = 0
+        winner = None
+        while True:
+            if self._is_over(game_state):
+                score = game_state.score(komi=self.komi)
+                if score.black != score.white:
+                    winner = Color.BLACK if score.black > score.white else Color.WHITE
+                break
+            key = self._key(game_state)
+            node = self.table.get(key)
+            if node is None:
+                self.table[key] = self._expand(game_state)
+                winner = Playout(game_state, rng=self.rng, komi=self.komi).run().winner
+                break
+
+            j = node.select(self.exploration)
+            color = game_state.current_color
+            path += [(node, j, color)]
+            move = node.moves[j]
+            try:
+                if move is None:
+                    game_state.pass_turn()
+                else:
+                    game_state.place_stone(game_state.board.position(move))
+            except IllegalMoveException:
+                # Reached by a transposition with a different history,
+                # where the move repeats a position, so it counts as a loss
+                winner = Color.WHITE if color == Color.BLACK else Color.BLACK
+                break
+            played += 1
+
+        for node, j, color in path:
+            node.total_visits += 1
+            node.visits[j] += 1
+            node.wins[j] += 1 if winner == color else 0.5 if winner is None else 0
+        for _ in range(played):
+            game_state.undo()
+
+    def search(
+        self,
+        game_state: GameState,
+        max_playouts: Optional[int] = None,
+        time_limit: Optional[float] = None,
+    ) -> AnalysisResult:
+        """
+        Searches from the given position, until either ``max_playouts``
+        iterations have been run, or ``time_limit`` seconds have passed
+
+        At least one of the limits must be given. The position is not modified
+        """
+        if max_playouts is None and time_limit is None:
+            raise ValueError("A playout or time limit is required")
+
+        if len(self.table) > self.max_nodes:
+            self.table.clear()
+
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        game_state = game_state.copy()
+        playouts = 0
+        while max_playouts is None or playouts < max_playouts:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            self._iterate(game_state)
+            playouts += 1
+
+        return self.result(game_state, playouts)
+
+    def result(self, game_state: GameState, playouts: int = 0) -> AnalysisResult:
+        """
+        The best move from the given position, by the number of visits,
+        and its win rate for the color to play, from the statistics so far
+        """
+        node = self.table.get(self._key(game_state))
+        if node is None:
+            return AnalysisResult(None, None, playouts, {})
+
+        moves = {
+            None if move is None else game_state.board.position(move): MoveStats(
+                visits, wins
+            )
+            for move, visits, wins in zip(node.moves, node.visits, node.wins)
+            if visits
+        }
+        return best_result(moves, playouts)
+
+
+def best_result(
+    moves: Dict[Optional[Position], MoveStats], playouts: int
+) -> AnalysisResult:
+    """
+    Chooses the most visited of the moves, see AnalysisResult
+    """
+    if not moves:
+        return AnalysisResult(None, None, playouts, moves)
+
+    move, stats = max(moves.items(), key=lambda item: item[1].visits)
+    return AnalysisResult(move, stats.wins / stats.visits, playouts, moves)
+
+
+# Searches kept by each worker process of ParallelMCTS, by komi,
+# so that trees are reused between searches in the same process
+_worker_searches: Dict[float, MCTS] = {}
+
+
+def _worker_search(
+    data: bytes,
+    komi: float,
+    max_playouts: Optional[int],
+    time_limit: Optional[float],
+    seed: int,
+) -> Tuple[int, Dict[Optional[int], Tuple[int, float]]]:
+    # Runs a search in a worker process, from a game packed with to_bytes,
+    # returning the number of playouts, and the visits and wins
+    # of each move from the root by index into the board
+    search = _worker_searches.get(komi)
+    if search is None:
+        search = _worker_searches[komi] = MCTS(komi=komi)
+    search.rng.seed(seed)
+
+    game_state = GameState.from_bytes(data)
+    result = search.search(game_state, max_playouts=max_playouts, time_limit=time_limit)
+    return result.playouts, {
+        None if move is None else game_state.board.index(move): tuple(stats)
+        for move, stats in result.moves.items()
+    }
+
+
+class ParallelMCTS(ProcessPoolBase):
+    """
+    Runs independent searches from the same position in several processes,
+    and merges the statistics of the moves from the root (root parallelism)
+
+    Each worker keeps its own tree between searches
+    """
+
+    def __init__(
+        self,
+        komi: float = 0,
+        workers: Optional[int] = None,
+        executor: Optional[Executor] = None,
+    ):
+        super().__init__(workers, executor)
+        self.komi = komi
+
+    def search(
+        self,
+        game_state: GameState,
+        max_playouts: Optional[int] = None,
+        time_limit: Optional[float] = None,
+        seed: Optional[int] = None,
+    ) -> AnalysisResult:
+        """
+        Searches from the given position, see MCTS.search
+
+        ``max_playouts`` is shared between the workers,
+        while each of them searches for up to ``time_limit`` seconds
+        """
+        if max_playouts is None and time_limit is None:
+            raise ValueError("A playout or time limit is required")
+
+        rng = random.Random(seed)
+        data = game_state.to_bytes()
+        futures = [
+            self.executor.submit(
+                _worker_search,
+                data,
+                self.komi,
+                (
+                    None
+                    if max_playouts is None
+                    else max_playouts // self.workers
+                    + (i < max_playouts % self.workers)
+                ),
+                time_limit,
+                rng.getrandbits(64),
+            )
+            for i in range(self.workers)
+        ]
+
+        playouts = 0
+        visits: Dict[Optional[int], int] = {}
+        wins: Dict[Optional[int], float] = {}
+        for future in futures:
+            worker_playouts, moves = future.result()
+            playouts += worker_playouts
+            for move, (move_visits, move_wins) in moves.items():
+                visits[move] = visits.get(move, 0) + move_visits
+                wins[move] = wins.get(move, 0) + move_wins
+
+        return best_result(
+            {
+                None if move is None else game_state.board.position(move): MoveStats(
+                    visits[move], wins[move]
+                )
+                for move in visits
+            },
+            playouts,
+        )
@@ -4,11 +4,12 @@ import asyncio
 
 from . import __version__
 from .errors import DataException, ServerFullException, VersionException
-from .models import ClientState, Color, Mode
-from .networking import ClientServerBase, ConnectionBase
+from .models import ClientState, Color, Mode, Stone
+from .networking import BINARY_OPTION, ClientServerBase, ConnectionBase
 from .ui import UI, EventType
 
 DEFAULT_HOST = "127.0.0.1"
+DEFAULT_ROOM = "default"
 
 
 class Connection(ConnectionBase):
@@ -24,39 +25,79 @@ class Client(ClientServerBase):
     Represents a client
     """
 
-    def __init__(self, host=None, port=None, timeout=None):
+    def __init__(
+        self, host=None, port=None, timeout=None, binary=True, room=None, watch=False
+    ):
         """
         Instantiates the client instance. This is usually done by the launcher
+
+        If ``binary`` is True, then binary framing is requested in the handshake.
+        ``room`` is the id of the room on the server to join,
+        as a spectator if ``watch`` is True
         """
         super().__init__(host=host if host else DEFAULT_HOST, port=port)
         self.state = ClientState()
         self.timeout = timeout
+        self.binary = binary
+        self.room = room if room else DEFAULT_ROOM
+        self.watch = watch
         self._connection = None
 
     async def _handshake(self):
-        await self._connection.send("go", __version__)
-        response = await self._connection.recv("no", "ok")
-        if "ok" not in response:
+        request = f"{__version__} {BINARY_OPTION}" if self.binary else __version__
+        await self._connection.send("go", request)
+        response = await self._connection.recv("no", "ok", "full")
+        if "full" in response:
+            raise ServerFullException()
+        elif "ok" not in response:
             raise VersionException(f"Server does not support version {__version__}")
-        elif response["ok"] != __version__:
+
+        version, *options = (response["ok"] or "").split() or [None]
+        if version != __version__ or any(
+            option != BINARY_OPTION or not self.binary for option in options
+        ):
             raise DataException(f"Invalid handshake response {response!r}")
+        self._connection.binary = BINARY_OPTION in options
 
     async def _setup(self):
+        await self._connection.send("watch" if self.watch else "join", self.room)
         response = await self._connection.recv("full", "mode")
         if "full" in response:
             raise ServerFullException()
 
         self.state.mode = response["mode"]
-        self.state.stones, self.state.board_size = (
-            await self._connection.recv("stones")
-        )["stones"]
+        if self.state.mode == Mode.NORMAL and not self.watch:
+            self.state.color = (await self._connection.recv("color"))["color"]
+
+        # Reports the last move the board has, if any, and applies the moves missing,
+        # or the whole board, until the sequence number of the latest move is sent
+        await self._connection.send(
+            "sync",
+            (self.state.game, self.state.seq) if self.state.board is not None else None,
+        )
+        while True:
+            response = await self._connection.recv("stones", "place", "remove", "seq")
+            if "seq" in response:
+                self.state.game, self.state.seq = response["seq"]
+                break
+            elif "stones" in response:
+                self.state.board = response["stones"][0].board
+            elif self.state.board is None:
+                raise DataException(f"Unexpected {response!r} without a board")
+            elif "place" in response:
+                if not isinstance(response["place"], Stone):
+                    raise DataException(f"Expected a stone, got {response!r}")
+                self.state.place(response["place"])
+            else:
+                self.state.remove(response["remove"])
 
         await self._connection.send("ack")
         await self._connection.recv("ready")
 
     async def _connect(self):
-        reader, writer = await asyncio.open_connection(self.host, self.port)
-        self._connection = Connection(reader, writer)
+        _, self._connection = await asyncio.get_running_loop().create_connection(
+            lambda: Connection(timeout=self.timeout), self.host, self.port
+        )
         await self._handshake()
         await self._setup()
 
@@ -65,6 +106,7 @@ class Client(ClientServerBase):
         Disconnects the client from the server
         """
         if self._connection is not None:
+            self._connection.queue("close")
             await self._connection.close()
 
     async def _event_worker(self):
@@ -72,10 +114,30 @@ class Client(ClientServerBase):
         # and dispatching them to the server
         while True:
             event = await self.state._outgoing_event_q.get()
-            # if event.type == EventType.PLACE_STONE:
-            #     self.state.place_stone(event.pos)
+            if event.type == EventType.PLACE_STONE and self.state.turn:
+                self.state.turn = False
+                await self._connection.send("place", event.pos)
             self.state._outgoing_event_q.task_done()
 
+    async def _message_worker(self):
+        # Message worker for applying the moves and turns sent by the server
+        while True:
+            response = await self._connection.recv(
+                "place", "remove", "yourturn", "close"
+            )
+            if "close" in response:
+                return
+            elif "place" in response:
+                if not isinstance(response["place"], Stone):
+                    raise DataException(f"Expected a stone, got {response!r}")
+                self.state.place(response["place"])
+            elif "remove" in response:
+                self.state.remove(response["remove"])
+            else:
+                if self.state.mode == Mode.LOCAL:
+                    self.state.color = response["yourturn"]
+                self.state.turn = True
+
     async def run(self):
         """
         Runs the client and connects to the server
@@ -86,5 +148,13 @@ class Client(ClientServerBase):
             self.state.color = Color.BLACK
         self.ui = UI(self.state)
 
-        await asyncio.gather(self._event_worker(), self.ui.run())
-        await self._disconnect()
+        workers = [
+            asyncio.create_task(worker())
+            for worker in (self._event_worker, self._message_worker)
+        ]
+        try:
+            await self.ui.run()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self.disconnect()
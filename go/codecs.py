@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+"""
+Encoding and decoding of the messages of the client-server protocol,
+for both text and binary framing, see protocol.rst
+"""
+
+import struct
+from array import array
+from collections import namedtuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .errors import DataException
+from .models import EMPTY, Board, Color, Mode, Position, Stone, StonesView
+
+VALID_BOARD_SIZES = (9, 13, 19)
+
+# Encoder and decoder of the value of a message, for one of the framings.
+# For text framing, values are encoded to and decoded from strings,
+# and for binary framing, to and from bytes. Both are None for messages
+# without a value
+Codec = namedtuple("Codec", "encode decode")
+# A registered message, with its codecs for text and binary framing,
+# and the prefixes of messages with a value for each framing
+Message = namedtuple("Message", "key code text binary text_prefix binary_prefix")
+
+# Registered messages, by key and by the code of the message in binary framing
+MESSAGES: Dict[str, Message] = {}
+MESSAGES_BY_CODE: List[Optional[Message]] = [None] * 256
+
+_BYTE = struct.Struct("B")
+
+# Translation between the values of board cells, as unsigned bytes,
+# and the characters of the stones string
+_STONES_ENCODE = bytearray(256)
+_STONES_ENCODE[EMPTY & 0xFF] = ord("X")
+_STONES_ENCODE[Color.BLACK.value] = ord(str(Color.BLACK.value))
+_STONES_ENCODE[Color.WHITE.value] = ord(str(Color.WHITE.value))
+_STONES_DECODE = bytearray(b"\x80") * 256  # 0x80 marks invalid characters
+_STONES_DECODE[ord("X")] = _STONES_DECODE[ord("x")] = EMPTY & 0xFF
+_STONES_DECODE[ord(str(Color.BLACK.value))] = Color.BLACK.value
+_STONES_DECODE[ord(str(Color.WHITE.value))] = Color.WHITE.value
+
+# Boards packed at 2 bits per intersection, four to a byte, first in the low bits,
+# with each intersection being its cell value plus one, and the lookup
+# from a packed byte to its four cell values
+_PACKED_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+_UNPACK = (
+    (np.arange(256, dtype=np.uint8)[:, np.newaxis] >> _PACKED_SHIFTS) & 3
+).astype(np.int8) - 1
+
+
+def encode_varint(n: int) -> bytes:
+    """
+    Encodes a non-negative integer in 7 bits per byte, least significant first,
+    with the high bit set on all but the last byte
+    """
+    data = bytearray()
+    while n >= 0x80:
+        data.append(n & 0x7F | 0x80)
+        n >>= 7
+    data.append(n)
+    return bytes(data)
+
+
+def decode_varint(data: bytes, offset: int = 0) -> Tuple[int, int]:
+    """
+    Decodes an integer encoded by encode_varint at the given offset,
+    returning it and the offset after it
+    """
+    n = shift = 0
+    while True:
+        if offset >= len(data):
+            raise DataException("Truncated integer")
+        byte = data[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+
+def pack_board(board: Board) -> bytes:
+    """
+    Packs the cells of a board at 2 bits per intersection
+    """
+    codes = np.frombuffer(board.cells, dtype=np.int8).astype(np.uint8) + 1
+    codes = np.pad(codes, (0, -len(codes) % 4)).reshape(-1, 4)
+    return np.bitwise_or.reduce(codes << _PACKED_SHIFTS, axis=1).tobytes()
+
+
+def unpack_board(data: bytes, board_size: int) -> Board:
+    """
+    Unpacks a board packed by pack_board
+    """
+    if len(data) != -(-(board_size ** 2) // 4):
+        raise DataException(f"Invalid length of packed board, got {len(data)}")
+    cells = _UNPACK[np.frombuffer(data, dtype=np.uint8)].ravel()[: board_size ** 2]
+    if (cells > Color.WHITE.value).any():
+        raise DataException("Invalid intersection in packed board")
+    return Board(board_size, array("b", cells.tobytes()))
+
+
+def register(
+    key: str,
+    code: int,
+    text: Optional[Codec] = None,
+    binary: Optional[Codec] = None,
+) -> Message:
+    """
+    Registers a message with the given key and code in binary framing,
+    with the codecs of its value. Messages without a value need no codecs
+    """
+    if key in MESSAGES or MESSAGES_BY_CODE[code] is not None:
+        raise ValueError(f"Message {key!r} or code {code} is already registered")
+
+    message = Message(
+        key,
+        code,
+        text if text is not None else Codec(None, None),
+        binary if binary is not None else Codec(None, None),
+        f"{key} ".encode(),
+        _BYTE.pack(code),
+    )
+    MESSAGES[key] = MESSAGES_BY_CODE[code] = message
+    return message
+
+
+def serialize(key: str, value: Any = None, binary: bool = False) -> bytes:
+    """
+    Serializes a message with the given key and value, including its framing
+    """
+    try:
+        message = MESSAGES[key]
+    except KeyError:
+        raise DataException(f"Unknown message {key!r}")
+
+    if binary:
+        body = message.binary_prefix
+        if message.binary.encode is not None:
+            body += message.binary.encode(value)
+        return encode_varint(len(body)) + body
+
+    encoded = message.text.encode(value) if message.text.encode is not None else ""
+    if not encoded:
+        return f"{key}\n".encode()
+    return message.text_prefix + encoded.encode() + b"\n"
+
+
+def deserialize(data: bytes, binary: bool = False) -> Tuple[str, Any]:
+    """
+    Deserializes a message, without its framing, returning its key and value
+    """
+    try:
+        if binary:
+            message = MESSAGES_BY_CODE[data[0]] if data else None
+            if message is None:
+                raise DataException("Unknown message code")
+            if message.binary.decode is None:
+                return (message.key, None)
+            return (message.key, message.binary.decode(bytes(data[1:])))
+
+        key, _, value = bytes(data).decode().partition(" ")
+        message = MESSAGES.get(key)
+        if message is None:
+            raise DataException(f"Unknown message {key!r}")
+        if message.text.decode is None or not value:
+            return (key, None)
+        return (key, message.text.decode(value))
+    except (ValueError, struct.error) as e:
+        # Includes errors decoding unicode
+        raise DataException(f"Invalid message {bytes(data)!r}") from e
+
+
+def _encode_str(value: Any) -> str:
+    return f"{value}"
+
+
+def _decode_str(value: str) -> str:
+    return value
+
+
+def _encode_utf8(value: Any) -> bytes:
+    return f"{value}".encode()
+
+
+def _decode_utf8(data: bytes) -> Optional[str]:
+    return data.decode() or None
+
+
+def _encode_mode(value: Mode) -> str:
+    return value.name.upper()
+
+
+def _decode_mode(value: str) -> Mode:
+    if value not in Mode.__members__:
+        raise DataException(f"{value!r} is not a valid mode")
+    return Mode[value]
+
+
+def _encode_mode_binary(value: Mode) -> bytes:
+    return _BYTE.pack(value.value)
+
+
+def _decode_mode_binary(data: bytes) -> Mode:
+    return Mode(*_BYTE.unpack(data))
+
+
+def _to_color(color_value: int) -> Color:
+    if color_value not in (Color.BLACK.value, Color.WHITE.value):
+        raise DataException(f"{color_value} is not a valid color value")
+    return Color(color_value)
+
+
+def _encode_color(value: Color) -> str:
+    return f"{value.value}"
+
+
+def _decode_color(value: str) -> Color:
+    try:
+        color_value = int(value)
+    except ValueError:
+        raise DataException(f"{value!r} is not a valid representation of a integer")
+    return _to_color(color_value)
+
+
+def _encode_color_binary(value: Color) -> bytes:
+    return _BYTE.pack(value.value)
+
+
+def _decode_color_binary(data: bytes) -> Color:
+    return _to_color(*_BYTE.unpack(data))
+
+
+def _board_from(stones, board_size: int) -> Board:
+    # The board of a mapping of position to stone, without copying if possible
+    if isinstance(stones, StonesView):
+        return stones.board
+    board = Board(board_size)
+    for pos, stone in stones.items():
+        board.cells[board.index(pos)] = stone.color.value
+    return board
+
+
+def _encode_stones(value) -> str:
+    return _board_from(*value).cells.tobytes().translate(_STONES_ENCODE).decode()
+
+
+def _decode_stones(value: str):
+    board_size = int(len(value) ** 0.5)
+    if board_size not in VALID_BOARD_SIZES or len(value) != board_size ** 2:
+        raise DataException(f"Invalid number of stones represented, got {len(value)}")
+
+    cells = value.encode().translate(_STONES_DECODE)
+    if b"\x80" in cells:
+        raise DataException(f"{value!r} is not a valid board")
+    board = Board(board_size, array("b", cells))
+    return (StonesView(board), board_size)
+
+
+def _encode_stones_binary(value) -> bytes:
+    board = _board_from(*value)
+    return encode_varint(board.size) + pack_board(board)
+
+
+def _decode_stones_binary(data: bytes):
+    board_size, offset = decode_varint(data)
+    if board_size not in VALID_BOARD_SIZES:
+        raise DataException(f"Invalid board size, got {board_size}")
+    return (StonesView(unpack_board(data[offset:], board_size)), board_size)
+
+
+# Messages with coordinates are encoded as a sequence of non-negative integers,
+# which are separated by spaces in text framing, and are varints in binary framing
+
+
+def _int_codecs(
+    to_ints: Callable[[Any], Iterable[int]], from_ints: Callable[[List[int]], Any]
+) -> Tuple[Codec, Codec]:
+    # Creates the codecs of a message encoded as a sequence of integers
+    def encode(value: Any) -> str:
+        return " ".join(map(str, to_ints(value)))
+
+    def decode(value: str) -> Any:
+        ints = [int(n) for n in value.split()]
+        if any(n < 0 for n in ints):
+            raise DataException(f"{value!r} contains a negative integer")
+        return from_ints(ints)
+
+    def encode_binary(value: Any) -> bytes:
+        return b"".join(map(encode_varint, to_ints(value)))
+
+    def decode_binary(data: bytes) -> Any:
+        ints = []
+        offset = 0
+        while offset < len(data):
+            n, offset = decode_varint(data, offset)
+            ints += [n]
+        return from_ints(ints)
+
+    return Codec(encode, decode), Codec(encode_binary, decode_binary)
+
+
+def _place_to_ints(value: Union[Position, Stone]) -> Tuple[int, ...]:
+    # A position requested by a client, or a stone placed, broadcast by the server
+    if isinstance(value, Stone):
+        return (value.color.value, *value.pos)
+    return tuple(value)
+
+
+def _place_from_ints(ints: List[int]) -> Union[Position, Stone]:
+    if len(ints) == 2:
+        return Position(*ints)
+    if len(ints) == 3:
+        return Stone(Position(*ints[1:]), _to_color(ints[0]))
+    raise DataException(f"Invalid placement {ints!r}")
+
+
+def _remove_to_ints(value: Iterable[Position]) -> List[int]:
+    return [n for pos in value for n in pos]
+
+
+def _remove_from_ints(ints: List[int]) -> List[Position]:
+    if len(ints) % 2:
+        raise DataException("Odd number of coordinates")
+    return [Position(*ints[i : i + 2]) for i in range(0, len(ints), 2)]
+
+
+def _sync_from_ints(ints: List[int]) -> Optional[Tuple[int, int]]:
+    # A client without a board sends no game id and sequence number
+    if ints and len(ints) != 2:
+        raise DataException(f"Invalid game and sequence number {ints!r}")
+    return tuple(ints) if ints else None
+
+
+def _seq_from_ints(ints: List[int]) -> Tuple[int, int]:
+    if len(ints) != 2:
+        raise DataException(f"Invalid game and sequence number {ints!r}")
+    return tuple(ints)
+
+
+def _seq_to_ints(value: Optional[Tuple[int, int]]) -> Tuple[int, ...]:
+    return () if value is None else tuple(value)
+
+
+def _encode_forward(value: Tuple[bool, bool, str]) -> str:
+    binary, watch, room_id = value
+    return f"{int(binary)} {int(watch)} {room_id}"
+
+
+def _decode_forward(value: str) -> Tuple[bool, bool, str]:
+    binary, watch, room_id = (value.split(" ", 2) + ["", ""])[:3]
+    if binary not in ("0", "1") or watch not in ("0", "1") or not room_id:
+        raise DataException(f"Invalid forwarded connection {value!r}")
+    return (binary == "1", watch == "1", room_id)
+
+
+def _encode_forward_binary(value: Tuple[bool, bool, str]) -> bytes:
+    binary, watch, room_id = value
+    return _BYTE.pack(binary | watch << 1) + room_id.encode()
+
+
+def _decode_forward_binary(data: bytes) -> Tuple[bool, bool, str]:
+    if not data or data[0] > 3:
+        raise DataException(f"Invalid forwarded connection {data!r}")
+    return (bool(data[0] & 1), bool(data[0] & 2), data[1:].decode())
+
+
+_STR_CODECS = (Codec(_encode_str, _decode_str), Codec(_encode_utf8, _decode_utf8))
+_COLOR_CODECS = (
+    Codec(_encode_color, _decode_color),
+    Codec(_encode_color_binary, _decode_color_binary),
+)
+
+register("go", 0, *_STR_CODECS)
+register("ok", 1, *_STR_CODECS)
+register("no", 2)
+register("full", 3)
+register(
+    "mode",
+    4,
+    Codec(_encode_mode, _decode_mode),
+    Codec(_encode_mode_binary, _decode_mode_binary),
+)
+register("color", 5, *_COLOR_CODECS)
+register(
+    "stones",
+    6,
+    Codec(_encode_stones, _decode_stones),
+    Codec(_encode_stones_binary, _decode_stones_binary),
+)
+register("ack", 7)
+register("ready", 8)
+register("yourturn", 9, *_COLOR_CODECS)
+register("place", 10, *_int_codecs(_place_to_ints, _place_from_ints))
+register("remove", 11, *_int_codecs(_remove_to_ints, _remove_from_ints))
+register("close", 12)
+register("sync", 13, *_int_codecs(_seq_to_ints, _sync_from_ints))
+register("seq", 14, *_int_codecs(_seq_to_ints, _seq_from_ints))
+register("join", 15, *_STR_CODECS)
+register("watch", 17, *_STR_CODECS)
+# Sent between the workers of a server, see go.server.serve_workers
+register(
+    "forward",
+    16,
+    Codec(_encode_forward, _decode_forward),
+    Codec(_encode_forward_binary, _decode_forward_binary),
+)
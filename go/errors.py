@@ -59,3 +59,19 @@ class DataException(ConnectionException):
     """
 
     pass
+
+
+class GameException(Exception):
+    """
+    Base class of all game-related exceptions
+    """
+
+    pass
+
+
+class IllegalMoveException(GameException):
+    """
+    The move is not permitted by the rules of the game
+    """
+
+    pass
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only journals of the moves played in each room of the server,
+and periodic snapshots of their games, for recovering games after a restart
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .errors import IllegalMoveException
+from .models import Color, GameState, Mode, Position
+
+JOURNAL_SUFFIX = ".journal"
+SNAPSHOT_SUFFIX = ".snapshot"
+JOURNAL_MAGIC = b"GOJ2"
+SNAPSHOT_MAGIC = b"GOS1"
+DEFAULT_FLUSH_INTERVAL = 0.05  # Seconds between writes of the moves played
+DEFAULT_SNAPSHOT_INTERVAL = 50  # Moves between snapshots of a game
+
+logger = logging.getLogger(__name__)
+
+# Header of a journal: magic, board size, the value of the mode, the game id,
+# and the length of the room id, followed by the room id in UTF-8,
+# and then a record for each move: its sequence number, color value, x and y
+_HEADER = struct.Struct("<4sBBIH")
+_RECORD = struct.Struct("<IBBB")
+# Header of a snapshot: magic and the sequence number of the last move,
+# followed by the game packed with GameState.to_bytes
+_SNAPSHOT_HEADER = struct.Struct("<4sI")
+
+# A move read from a journal
+JournalEntry = namedtuple("JournalEntry", "seq color pos")
+# The game of a room read from a journal. ``snapshot`` is the latest snapshot,
+# as a pair of sequence number and game, or None if there is none
+JournaledGame = namedtuple(
+    "JournaledGame", "room_id board_size mode game entries snapshot"
+)
+
+
+def journal_path(directory: str, room_id: str, suffix: str = JOURNAL_SUFFIX) -> str:
+    """
+    The path of the journal of the room with the given id,
+    or of another of its files with the given suffix
+    """
+    # Room ids may contain any characters, and be too long for a file name,
+    # so files are named by a digest of the id, which is in the header
+    name = hashlib.blake2b(room_id.encode(), digest_size=16).hexdigest()
+    return os.path.join(directory, name + suffix)
+
+
+def _header_size(room_id: str) -> int:
+    return _HEADER.size + len(room_id.encode())
+
+
+def read_snapshot(path: str) -> Optional[Tuple[int, GameState]]:
+    """
+    Reads a snapshot, as a pair of the sequence number of the last move
+    and the game, or None if it does not exist or is not valid
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, seq = _SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        return seq, GameState.from_bytes(data[_SNAPSHOT_HEADER.size :])
+    except (ValueError, OSError, struct.error):
+        return None
+
+
+def read_journal(
+    path: str, owned: Optional[Callable[[str], bool]] = None
+) -> Optional[JournaledGame]:
+    """
+    Reads the game from a journal, or None if it is not a valid journal,
+    or ``owned`` is given and returns False for the id of its room,
+    in which case only the header is read
+
+    Moves are read up to the first incomplete or invalid record, which is left
+    if writing it was interrupted. A snapshot of a different board size,
+    or of a move after those read, is ignored
+    """
+    try:
+        with open(path, "rb") as f:
+            magic, board_size, mode_value, game, length = _HEADER.unpack(
+                f.read(_HEADER.size)
+            )
+            if magic != JOURNAL_MAGIC:
+                return None
+            room_id = f.read(length).decode()
+            if len(room_id.encode()) != length:
+                return None
+            if owned is not None and not owned(room_id):
+                return None
+            data = f.read()
+        mode = Mode(mode_value)
+    except (ValueError, OSError, struct.error):
+        return None
+
+    end = len(data) // _RECORD.size * _RECORD.size
+    entries = []
+    for seq, color_value, x, y in _RECORD.iter_unpack(data[:end]):
+        if color_value not in (Color.BLACK.value, Color.WHITE.value):
+            break
+        entries += [JournalEntry(seq, Color(color_value), Position(x, y))]
+
+    snapshot = read_snapshot(path[: -len(JOURNAL_SUFFIX)] + SNAPSHOT_SUFFIX)
+    if snapshot is not None and (
+        snapshot[1].board_size != board_size or snapshot[0] > len(entries)
+    ):
+        snapshot = None
+    return JournaledGame(room_id, board_size, mode, game, entries, snapshot)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_batch(
+    directory: str,
+    batch: Dict[str, Optional[Tuple[bool, bytes]]],
+    snapshots: Dict[str, bytes],
+):
+    # Writes a batch of changes to journals, by room id, syncing them to disk,
+    # and then the snapshots taken, so that no snapshot is ahead of its journal.
+    # Each change is either data to append, and whether the journal
+    # is to be created first, or None if the journal is to be deleted.
+    # Creating or deleting a journal also deletes the snapshot.
+    # Changes are removed from the batch once written, so that if writing fails,
+    # those left can be written again, and data partly appended is truncated.
+    # A room whose changes cannot be written does not stop those of the others
+    # being written, and the first error is raised once they have been
+    error = None
+    created_or_deleted = False
+    for room_id, change in list(batch.items()):
+        try:
+            created_or_deleted |= _write_change(directory, room_id, change)
+        except OSError as e:
+            error = error or e
+        else:
+            del batch[room_id]
+
+    for room_id, data in list(snapshots.items()):
+        if room_id in batch:
+            # Not written ahead of the journal
+            continue
+        try:
+            _write_snapshot(directory, room_id, data)
+        except OSError as e:
+            error = error or e
+        else:
+            created_or_deleted = True
+            del snapshots[room_id]
+
+    if created_or_deleted and hasattr(os, "O_DIRECTORY"):
+        # Syncs the directory, so that the files created or deleted are too
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    if error is not None:
+        raise error
+
+
+def _write_change(
+    directory: str, room_id: str, change: Optional[Tuple[bool, bytes]]
+) -> bool:
+    # Writes a change to a journal, see _write_batch,
+    # returning whether the journal was created or deleted
+    path = journal_path(directory, room_id)
+    if change is None:
+        _remove(path)
+        _remove(journal_path(directory, room_id, SNAPSHOT_SUFFIX))
+        return True
+
+    create, data = change
+    if create:
+        _remove(journal_path(directory, room_id, SNAPSHOT_SUFFIX))
+    with open(path, "wb" if create else "ab") as f:
+        size = f.tell()
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except OSError:
+            f.truncate(size)
+            raise
+    return create
+
+
+def _write_snapshot(directory: str, room_id: str, data: bytes):
+    # Written to a temporary file first, and renamed over the previous one,
+    # so that a snapshot is never left partly written
+    path = journal_path(directory, room_id, SNAPSHOT_SUFFIX)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class Journal:
+    """
+    Journals of the moves of each room, as files in a directory
+
+    Changes are collected in memory, and written in batches every
+    ``flush_interval`` seconds in a separate thread, so that writing
+    and syncing to disk does not block the event loop.
+    A game should be snapshotted every ``snapshot_interval`` moves,
+    so that recovering it only replays the moves since
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        snapshot_interval: int = DEFAULT_SNAPSHOT_INTERVAL,
+        executor: Optional[Executor] = None,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        # Batches are written one at a time, in order
+        self._own_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(1)
+        self._pending: Dict[str, Optional[Tuple[bool, bytearray]]] = {}
+        self._snapshots: Dict[str, bytes] = {}
+        self._task = None
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, room_id: str, board_size: int, mode: Mode, game: int):
+        """
+        Starts a new journal for the game with the given id in the room,
+        replacing any existing one
+        """
+        encoded_id = room_id.encode()
+        self._pending[room_id] = (
+            True,
+            bytearray(
+                _HEADER.pack(
+                    JOURNAL_MAGIC, board_size, mode.value, game, len(encoded_id)
+                )
+                + encoded_id
+            ),
+        )
+
+    def append(self, room_id: str, seq: int, color: Color, pos: Position):
+        """
+        Appends a move to the journal of the room
+        """
+        change = self._pending.get(room_id)
+        if change is None:
+            change = self._pending[room_id] = (False, bytearray())
+        change[1].extend(_RECORD.pack(seq, color.value, *pos))
+
+    def snapshot(self, room_id: str, seq: int, game_state: GameState):
+        """
+        Snapshots the game of the room, after the move with the given
+        sequence number, replacing the previous snapshot
+        """
+        self._snapshots[room_id] = (
+            _SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq) + game_state.to_bytes()
+        )
+
+    def remove(self, room_id: str):
+        """
+        Deletes the journal of the room, and its snapshot
+        """
+        self._pending[room_id] = None
+        self._snapshots.pop(room_id, None)
+
+    def truncate(self, room_id: str, moves: int, keep_snapshot: bool = False):
+        """
+        Truncates the journal of the room after the given number of moves,
+        such as those recovered from it, so that the moves appended next
+        follow them, rather than any partly written record after them.
+        The snapshot is deleted, unless ``keep_snapshot`` is True
+
+        This writes to the journal immediately, so is only for recovering games
+        before changes are written periodically, see start
+        """
+        with open(journal_path(self.directory, room_id), "r+b") as f:
+            f.truncate(_header_size(room_id) + moves * _RECORD.size)
+            f.flush()
+            os.fsync(f.fileno())
+        if not keep_snapshot:
+            _remove(journal_path(self.directory, room_id, SNAPSHOT_SUFFIX))
+
+    def games(
+        self, owned: Optional[Callable[[str], bool]] = None
+    ) -> Iterator[JournaledGame]:
+        """
+        Reads the games from every journal in the directory, or only those
+        of the rooms for whose ids ``owned`` returns True, if it is given
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith(JOURNAL_SUFFIX):
+                game = read_journal(os.path.join(self.directory, name), owned)
+                if game is not None:
+                    yield game
+
+    async def flush(self):
+        """
+        Writes all the changes so far, waiting until they are on disk
+
+        Raises OSError if writing fails, in which case the changes not written
+        are kept, to be written with those made since on the next flush
+        """
+        batch, self._pending = self._pending, {}
+        snapshots, self._snapshots = self._snapshots, {}
+        if not batch and not snapshots:
+            return
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, _write_batch, self.directory, batch, snapshots
+            )
+        except OSError:
+            self._keep(batch, snapshots)
+            raise
+
+    def _keep(
+        self,
+        batch: Dict[str, Optional[Tuple[bool, bytearray]]],
+        snapshots: Dict[str, bytes],
+    ):
+        # Puts back changes that were not written, before those made since
+        for room_id, change in self._pending.items():
+            kept = batch.get(room_id)
+            if change is not None and not change[0] and kept is not None:
+                batch[room_id] = (kept[0], kept[1] + change[1])
+            else:
+                batch[room_id] = change
+            if change is None or change[0]:
+                # Snapshots of a journal since created or deleted are stale
+                snapshots.pop(room_id, None)
+        snapshots.update(self._snapshots)
+        self._pending, self._snapshots = batch, snapshots
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except OSError:
+                logger.exception("Failed to write journals, retrying")
+
+    def start(self):
+        """
+        Starts writing changes periodically, on the running event loop
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        """
+        Stops writing changes periodically, and writes those remaining
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._own_executor:
+            self.executor.shutdown()
+
+
+def replay(entries: List[JournalEntry], play, seq: int = 0) -> int:
+    """
+    Replays the moves read from a journal after the given sequence number,
+    such as that of a snapshot, with ``play``, a function placing a stone
+    at a position for the color to play, and returning that color,
+    stopping at the first move out of sequence, or that was not legal
+
+    Returns the sequence number of the last move replayed
+    """
+    for entry in entries[seq:]:
+        if entry.seq != seq + 1:
+            break
+        try:
+            if play(entry.pos) != entry.color:
+                break
+        except IllegalMoveException:
+            break
+        seq += 1
+
+    return seq
@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import random
+import struct
+from array import array
 from collections import namedtuple
+from collections.abc import Mapping
 from enum import Enum, auto
-from typing import Dict, List, Optional, Set, Tuple
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .errors import IllegalMoveException
 
 DEFAULT_BOARD_SIZE = 19
+EMPTY = -1  # Value of an empty intersection in a Board, see Color for stones
+NO_INDEX = -1  # Stands for no index into a Board, where one is optional
+
+# Header of GameState.to_bytes: board size, current color, index of the ko point,
+# prisoners of black and white, and number of hashes seen
+_STATE_HEADER = struct.Struct("<BbhIII")
 
 
 class Mode(Enum):
@@ -27,6 +42,15 @@ class Color(Enum):
     ALL = -1  # For use in local games
 
 
+class ScoringMethod(Enum):
+    """
+    Methods of scoring a game
+    """
+
+    TERRITORY = auto()  # Surrounded empty intersections, plus prisoners
+    AREA = auto()  # Surrounded empty intersections, plus stones on the board
+
+
 class Direction(Enum):
     """
     The permitted directions on the board
@@ -111,71 +135,386 @@ class Stone(Ring):
     Represents a stone. Inherits from Ring
     """
 
-    def __init__(self, pos: Position, color: Color):
-        super().__init__(pos, color)
-        self.group = Group(color, self)
-        self.liberties = {direction: True for direction in Direction}
+    def __repr__(self):
+        return f"{type(self).__name__}(pos={self.pos}, color={self.color})"
 
-    @property
-    def is_free(self):
-        return any(self.liberties.values())
+    def __str__(self):
+        return f"{type(self).__name__} at {self.pos!r}>"
+
+
+class DisjointSet:
+    """
+    Disjoint-set forest over the integers ``0`` to ``size - 1``,
+    using union by size and path compression
+
+    The members of each set are also linked in a circular list,
+    so that a set can be enumerated without storing its members separately
+    """
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+        self.size = [1] * size
+        self.next = list(range(size))
+
+    def make_set(self, i: int):
+        """
+        Makes ``i`` the sole member of a new set
+        """
+        self.parent[i] = i
+        self.size[i] = 1
+        self.next[i] = i
+
+    def find(self, i: int) -> int:
+        """
+        Finds the representative (root) of the set containing ``i``
+        """
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+
+        return root
+
+    def union(self, i: int, j: int) -> int:
+        """
+        Merges the sets containing ``i`` and ``j``, and returns the new root
+        """
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return i
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+        # Splices the two circular member lists together
+        self.next[i], self.next[j] = self.next[j], self.next[i]
+
+        return i
+
+    def members(self, i: int) -> List[int]:
+        """
+        The members of the set containing ``i``
+        """
+        members = [i]
+        j = self.next[i]
+        while j != i:
+            members += [j]
+            j = self.next[j]
+
+        return members
+
+
+@lru_cache(maxsize=None)
+def neighbour_table(board_size: int) -> Tuple[Tuple[int, ...], ...]:
+    """
+    For each index into a flat board of the given size,
+    the indices of the orthogonally adjacent intersections that are on the board
+    """
+    table = []
+    for i in range(board_size ** 2):
+        y, x = divmod(i, board_size)
+        table += [
+            tuple(
+                (y + dy) * board_size + x + dx
+                for dx, dy in (direction.value for direction in Direction)
+                if 0 <= x + dx < board_size and 0 <= y + dy < board_size
+            )
+        ]
+
+    return tuple(table)
+
+
+@lru_cache(maxsize=None)
+def zobrist_table(board_size: int) -> Tuple[Tuple[int, ...], ...]:
+    """
+    Random 64-bit keys for each color of stone, at each index into a flat board
+
+    Keys are seeded by the board size, so that hashes of positions
+    are the same in every process
+    """
+    rng = random.Random(board_size)
+    return tuple(
+        tuple(rng.getrandbits(64) for _ in range(board_size ** 2))
+        for _ in (Color.BLACK, Color.WHITE)
+    )
+
+
+class Board:
+    """
+    Compact representation of the intersections of a board
+
+    Intersections are stored in a flat array of bytes, from left to right,
+    top to bottom, each holding either ``EMPTY`` or the value of a Color
+    """
+
+    __slots__ = ("size", "cells", "neighbours")
+
+    def __init__(self, size: int, cells: Optional[array] = None):
+        self.size = size
+        self.cells = array("b", [EMPTY]) * size ** 2 if cells is None else cells
+        self.neighbours = neighbour_table(size)
+
+    def index(self, pos: Position) -> int:
+        """
+        The index into ``cells`` of the specified position,
+        which is assumed to be on the board, see on_board
+        """
+        return pos[1] * self.size + pos[0]
+
+    def on_board(self, pos: Position) -> bool:
+        """
+        Whether the specified position is on the board
+        """
+        return 0 <= pos[0] < self.size and 0 <= pos[1] < self.size
+
+    def position(self, index: int) -> Position:
+        """
+        The position of the specified index into ``cells``
+        """
+        y, x = divmod(index, self.size)
+        return Position(x, y)
+
+    def copy(self) -> "Board":
+        """
+        Copies the board, which is a single copy of the underlying buffer
+        """
+        return type(self)(self.size, self.cells[:])
+
+    def __eq__(self, other):
+        if isinstance(other, type(self)):
+            return self.size == other.size and self.cells == other.cells
+        return NotImplemented
 
     def __repr__(self):
-        return (
-            f"{type(self).__name__}(pos={self.pos}, color={self.color}, "
-            f"group={self.group!r}, liberties={self.liberties})"
+        return f"Board(size={self.size})"
+
+
+def ownership(board: np.ndarray) -> np.ndarray:
+    """
+    For each intersection of a board array, the color that owns it
+
+    The board array holds ``EMPTY`` or the value of a Color for each intersection,
+    with the last two axes being the rows and columns of the board.
+    Stones are owned by their own color, and empty intersections by the color
+    of the stones that surround their region of connected empty intersections,
+    or ``EMPTY`` if bordered by both colors, or neither.
+    No attempt is made to identify dead stones.
+    """
+    # Surrounds each board with an edge that is neither empty nor a color,
+    # so that adjacent intersections are at fixed offsets in the flattened array
+    edge = max(color.value for color in Color) + 1
+    padded = np.pad(
+        board, [(0, 0)] * (board.ndim - 2) + [(1, 1), (1, 1)], constant_values=edge
+    )
+    flat = padded.ravel()
+    width = padded.shape[-1]
+    offsets = (-width, width, -1, 1)
+    empty = np.flatnonzero(flat == EMPTY)
+    adjacent = [empty + offset for offset in offsets]
+
+    # Labels each empty region with the lowest flat index in the region,
+    # by propagating labels to adjacent empty intersections,
+    # and following labels to the label of the intersection they name.
+    # Intersections that are not empty keep a label greater than any index
+    none = flat.size
+    labels = np.full(none, none, dtype=np.int32)
+    labels[empty] = empty
+    while True:
+        previous = labels[empty]
+        current = previous
+        for indices in adjacent:
+            current = np.minimum(current, labels[indices])
+        labels[empty] = current
+        labels[empty] = labels[labels[empty]]
+        if np.array_equal(previous, labels[empty]):
+            break
+
+    # Finds the colors of the stones bordering each empty region
+    regions = labels[empty]
+    borders = {}
+    for color in (Color.BLACK, Color.WHITE):
+        touches = np.logical_or.reduce(
+            [flat[indices] == color.value for indices in adjacent]
         )
+        borders[color] = np.zeros(none, dtype=bool)
+        borders[color][regions[touches]] = True
 
-    def __str__(self):
-        return f"{type(self).__name__} at {self.pos!r}>"
+    black, white = (borders[color][regions] for color in (Color.BLACK, Color.WHITE))
+    owners = flat.copy()
+    owners[empty] = EMPTY
+    owners[empty[black & ~white]] = Color.BLACK.value
+    owners[empty[white & ~black]] = Color.WHITE.value
+    return owners.reshape(padded.shape)[..., 1:-1, 1:-1]
+
+
+Score = namedtuple("Score", "black white")
+# Counts of stones, territory (owned empty intersections) and area
+# (stones plus territory) for a stack of boards, each an N x 2 array
+# with a column for each of black and white
+BoardCounts = namedtuple("BoardCounts", "stones territory area")
+
+# Lookup from characters of the stones string of the protocol to board values
+_STONE_CHAR_VALUES = np.full(256, EMPTY - 1, dtype=np.int8)
+_STONE_CHAR_VALUES[[ord("X"), ord("x")]] = EMPTY
+_STONE_CHAR_VALUES[ord(str(Color.BLACK.value))] = Color.BLACK.value
+_STONE_CHAR_VALUES[ord(str(Color.WHITE.value))] = Color.WHITE.value
+
+
+def boards_from_strings(strings: List[str]) -> np.ndarray:
+    """
+    Stacks boards given as stones strings of the protocol into an N x size x size
+    board array, for use with count_boards and score_boards
+
+    All boards must be of the same size
+    """
+    data = np.frombuffer("".join(strings).encode("ascii"), dtype=np.uint8)
+    size = int(round((len(data) / max(len(strings), 1)) ** 0.5))
+    if size * size * len(strings) != len(data):
+        raise ValueError("Boards are not all of the same square size")
+
+    boards = _STONE_CHAR_VALUES[data]
+    if (boards < EMPTY).any():
+        raise ValueError("Invalid character in stones string")
+
+    return boards.reshape(len(strings), size, size)
+
+
+def count_boards(boards: np.ndarray) -> BoardCounts:
+    """
+    Counts stones, territory and area of each color on a stack of boards,
+    in a single pass over the whole stack
+
+    Every stone on the board is treated as alive, see the ownership function
+    """
+    owners = ownership(boards)
+    empty = boards == EMPTY
+    stones, territory = [], []
+    for color in (Color.BLACK, Color.WHITE):
+        stones += [np.count_nonzero(boards == color.value, axis=(-2, -1))]
+        territory += [np.count_nonzero(empty & (owners == color.value), axis=(-2, -1))]
+
+    stones, territory = np.stack(stones, axis=-1), np.stack(territory, axis=-1)
+    return BoardCounts(stones, territory, stones + territory)
+
+
+def score_boards(
+    boards: np.ndarray,
+    method: ScoringMethod = ScoringMethod.AREA,
+    komi: float = 0,
+    prisoners: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Scores a stack of boards, returning an N x 2 array of black and white scores,
+    with komi given to white
+
+    For territory scoring, ``prisoners`` is an N x 2 array of the number of stones
+    captured by black and white in each game, otherwise none are counted
+    """
+    counts = count_boards(boards)
+    if method == ScoringMethod.AREA:
+        scores = counts.area.astype(float)
+    else:
+        scores = counts.territory.astype(float)
+        if prisoners is not None:
+            scores += prisoners
+
+    scores[..., 1] += komi
+    return scores
+
+
+class StonesView(Mapping):
+    """
+    Read-only mapping of position to stone, backed by a Board
+    """
+
+    def __init__(self, board: Board):
+        self.board = board
+
+    def __getitem__(self, pos: Position) -> Stone:
+        if not self.board.on_board(pos):
+            raise KeyError(pos)
+        color = self.board.cells[self.board.index(pos)]
+        if color == EMPTY:
+            raise KeyError(pos)
+        return Stone(Position(*pos), Color(color))
+
+    def __iter__(self) -> Iterator[Position]:
+        for i, color in enumerate(self.board.cells):
+            if color != EMPTY:
+                yield self.board.position(i)
+
+    def __len__(self):
+        return sum(1 for color in self.board.cells if color != EMPTY)
 
 
 class Group:
     """
-    Represents a group of connected stones
+    A view of a group of connected stones in a game, and its liberties
     """
 
-    def __init__(self, color: Color, *stones: Stone):
-        self.color = color
-        self.stones = list(stones)
+    def __init__(self, game_state: "GameState", root: int):
+        self.game_state = game_state
+        self.root = root
 
     @property
-    def can_capture(self):
+    def color(self) -> Color:
+        return Color(self.game_state.board.cells[self.root])
+
+    @property
+    def stones(self) -> List[Stone]:
         """
-        Whether or not this group can be captured
+        The stones in the group
         """
-        return all(not stone.is_free for stone in self.stones)
+        color = self.color
+        return [
+            Stone(self.game_state.board.position(i), color)
+            for i in self.game_state._groups.members(self.root)
+        ]
 
-    @classmethod
-    def merge(cls, groups: List["Group"]):
+    @property
+    def liberties(self) -> Set[Position]:
+        """
+        The liberties of the group
         """
-        Merge groups of stones together
+        return {
+            self.game_state.board.position(i)
+            for i in self.game_state._liberties[self.root]
+        }
 
-        If the length of ``groups`` is 1, then return that group
+    @property
+    def can_capture(self):
         """
-        if len(groups) == 1:
-            return groups[0]
+        Whether or not this group can be captured
+        """
+        return not self.game_state._liberties[self.root]
 
-        color = groups[0].color
-        new_group = cls(color)
-        for group in groups:
-            for stone in group:
-                new_group.stones += [stone]
-                stone.group = new_group
+    def __iter__(self):
+        return iter(self.stones)
 
-        return new_group
+    def __len__(self):
+        return self.game_state._groups.size[self.root]
 
-    def __iter__(self):
-        return iter(self.stones[:])
+    def __eq__(self, other):
+        if isinstance(other, type(self)):
+            return self.game_state is other.game_state and self.root == other.root
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.game_state), self.root))
 
     def __repr__(self):
         return f"Group(color={self.color}, stones={self.stones})"
 
     def __str__(self):
-        return f"Group of {len(self.stones)} stones of color {self.color.name}"
+        return f"Group of {len(self)} stones of color {self.color.name}"
 
 
-HistoryEntry = namedtuple("HistoryEntry", "pos captures")
+# A move in the history of a game. ``pos`` is None for a pass
+HistoryEntry = namedtuple("HistoryEntry", "pos color captures ko_point hash")
+NO_CAPTURES = {color: None for color in Color}
 
 
 class GameState:
@@ -186,10 +525,138 @@ class GameState:
     def __init__(self, board_size: Optional[int] = None):
         # Game state
         self.current_color = Color.BLACK
-        self.stones: Dict[Position, Stone] = {}
-        self.history = []
+        self.ko_point: Optional[Position] = None
+        self.history: List[HistoryEntry] = []
         self.history_position = 0
         self.board_size = board_size if board_size is not None else DEFAULT_BOARD_SIZE
+        self.board = Board(self.board_size)
+
+        # Connectivity of stones, by index into the board.
+        # Liberties are stored against the root of each group
+        self._groups = DisjointSet(self.board_size ** 2)
+        self._liberties: Dict[int, Set[int]] = {}
+
+        # Zobrist hash of the stones on the board, and the number of times
+        # each hash has occurred in the history, for positional superko
+        self._zobrist = zobrist_table(self.board_size)
+        self.position_hash = 0
+        self._seen_hashes: Dict[int, int] = {0: 1}
+
+        # Number of stones captured by each color, and ownership of
+        # the board for the hash it was last computed for
+        self.prisoners = {Color.BLACK: 0, Color.WHITE: 0}
+        self._ownership: Optional[Tuple[int, np.ndarray]] = None
+
+        # Whether each intersection is a legal move for each color,
+        # ignoring superko. This is kept up to date by only re-evaluating
+        # intersections that have changed, those adjacent to them,
+        # and the liberties of groups whose number of liberties has changed
+        # to or from one, along with the liberty count before the change
+        self._legal = {
+            color: bytearray([True]) * self.board_size ** 2
+            for color in (Color.BLACK, Color.WHITE)
+        }
+        self._changed: Set[int] = set()
+        self._changed_roots: Dict[int, Optional[int]] = {}
+        self._legality_ko: Optional[int] = None
+
+    @classmethod
+    def from_board(
+        cls,
+        board: Board,
+        current_color: Color = Color.BLACK,
+        ko_point: Optional[Position] = None,
+    ) -> "GameState":
+        """
+        Creates a game from a board, which is copied, with no history
+        """
+        game_state = cls(board.size)
+        game_state.board = board.copy()
+        game_state.current_color = current_color
+        game_state.ko_point = ko_point
+        game_state.update_liberties()
+        for i, color in enumerate(game_state.board.cells):
+            if color != EMPTY:
+                game_state.position_hash ^= game_state._zobrist[color][i]
+        game_state._seen_hashes = {game_state.position_hash: 1}
+
+        return game_state
+
+    def to_bytes(self) -> bytes:
+        """
+        Packs the board, color to play, ko point, prisoners and the hashes
+        of positions seen (for superko) into a compact binary form,
+        see from_bytes
+
+        The history of moves is not included
+        """
+        hashes = array("Q", self._seen_hashes)
+        return (
+            _STATE_HEADER.pack(
+                self.board_size,
+                self.current_color.value,
+                NO_INDEX if self.ko_point is None else self.board.index(self.ko_point),
+                self.prisoners[Color.BLACK],
+                self.prisoners[Color.WHITE],
+                len(hashes),
+            )
+            + self.board.cells.tobytes()
+            + hashes.tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "GameState":
+        """
+        Creates a game from the binary form produced by to_bytes
+        """
+        (
+            board_size,
+            color,
+            ko_index,
+            black_prisoners,
+            white_prisoners,
+            hash_count,
+        ) = _STATE_HEADER.unpack_from(data)
+        offset = _STATE_HEADER.size
+        cells = array("b", data[offset : offset + board_size ** 2])
+        hashes = array("Q", data[offset + board_size ** 2 :])
+        if len(cells) != board_size ** 2 or len(hashes) != hash_count:
+            raise ValueError("Truncated game state")
+
+        board = Board(board_size, cells)
+        game_state = cls.from_board(
+            board,
+            Color(color),
+            None if ko_index == NO_INDEX else board.position(ko_index),
+        )
+        game_state.prisoners = {
+            Color.BLACK: black_prisoners,
+            Color.WHITE: white_prisoners,
+        }
+        game_state._seen_hashes.update((h, 1) for h in hashes)
+
+        return game_state
+
+    def copy(self) -> "GameState":
+        """
+        Copies the game, including its history
+        """
+        game_state = type(self).from_board(
+            self.board, self.current_color, self.ko_point
+        )
+        game_state.history = self.history[:]
+        game_state.history_position = self.history_position
+        game_state._seen_hashes = dict(self._seen_hashes)
+        game_state.prisoners = dict(self.prisoners)
+
+        return game_state
+
+    @property
+    def stones(self) -> StonesView:
+        """
+        The stones on the board, by position
+        """
+        return StonesView(self.board)
 
     @property
     def groups(self) -> Dict[Color, Set[Group]]:
@@ -197,11 +664,25 @@ class GameState:
         The groups of stones in the game
         """
         groups = {color: set() for color in Color}
-        for stone in self.stones.values():
-            groups[stone.color].add(stone.group)
+        for i, color in enumerate(self.board.cells):
+            if color != EMPTY:
+                groups[Color(color)].add(Group(self, self._groups.find(i)))
 
         return groups
 
+    def group_at(self, pos: Position) -> Group:
+        """
+        The group of the stone at the specified position
+
+        Raises KeyError if there is no stone there, or it is not on the board
+        """
+        if not self.board.on_board(pos):
+            raise KeyError(pos)
+        index = self.board.index(pos)
+        if self.board.cells[index] == EMPTY:
+            raise KeyError(pos)
+        return Group(self, self._groups.find(index))
+
     def toggle_color(self):
         """
         Toggle the current color whose turn it is
@@ -210,54 +691,479 @@ class GameState:
             Color.WHITE if self.current_color == Color.BLACK else Color.BLACK
         )
 
+    def neighbours(self, pos: Position) -> List[Position]:
+        """
+        The positions orthogonally adjacent to ``pos`` that are on the board
+        """
+        return [
+            self.board.position(i) for i in self.board.neighbours[self.board.index(pos)]
+        ]
+
+    def legal_mask(self, color: Optional[Color] = None) -> memoryview:
+        """
+        Whether each intersection, by index into the board, is a legal move
+        for the specified color, or the current color if not specified
+
+        This is a read-only view that is kept up to date as the game changes,
+        so is obtained in constant time. Positional superko is not taken
+        into account, see is_legal
+        """
+        if color is None:
+            color = self.current_color
+        return memoryview(self._legal[color]).toreadonly()
+
+    def legal_moves(self, color: Optional[Color] = None) -> List[Position]:
+        """
+        The positions that are legal moves for the specified color,
+        or the current color if not specified, ignoring positional superko
+        """
+        return [
+            self.board.position(i)
+            for i, legal in enumerate(self.legal_mask(color))
+            if legal
+        ]
+
+    def is_legal(self, pos: Position, color: Optional[Color] = None) -> bool:
+        """
+        Whether a stone of the specified color, or the current color
+        if not specified, can be placed at the specified position,
+        which is never the case for a position not on the board
+        """
+        if color is None:
+            color = self.current_color
+        if not self.board.on_board(pos):
+            return False
+        index = self.board.index(pos)
+        return bool(self._legal[color][index]) and (
+            self._resulting_hash(index, color.value) not in self._seen_hashes
+        )
+
+    def _resulting_hash(self, index: int, color: int) -> int:
+        # The hash of the position after a stone of the given color is placed
+        # at the given index, taking into account any captures,
+        # without modifying the board. The move is assumed not to be suicide
+        cells = self.board.cells
+        zobrist = self._zobrist
+        new_hash = self.position_hash ^ zobrist[color][index]
+        seen_roots = []
+        for adj_index in self.board.neighbours[index]:
+            adj_color = cells[adj_index]
+            if adj_color in (EMPTY, color):
+                continue
+
+            adj_root = self._groups.find(adj_index)
+            if adj_root not in seen_roots and len(self._liberties[adj_root]) == 1:
+                seen_roots += [adj_root]
+                for i in self._groups.members(adj_root):
+                    new_hash ^= zobrist[adj_color][i]
+
+        return new_hash
+
+    def _refresh_legality(self):
+        # Re-evaluates the legality of the intersections that may have changed
+        cells = self.board.cells
+        neighbours = self.board.neighbours
+        points = set()
+        for i in self._changed:
+            points.add(i)
+            points.update(neighbours[i])
+        for root, count in self._changed_roots.items():
+            liberties = self._liberties.get(root)
+            if liberties is not None and (
+                count is None or (count == 1) != (len(liberties) == 1)
+            ):
+                points |= liberties
+
+        # The ko point is only illegal for the current color
+        ko = None if self.ko_point is None else self.board.index(self.ko_point)
+        for i in (self._legality_ko, ko):
+            if i is not None:
+                points.add(i)
+        self._legality_ko = ko
+        self._changed.clear()
+        self._changed_roots.clear()
+
+        legal_masks = (self._legal[Color.BLACK], self._legal[Color.WHITE])
+        for i in points:
+            if cells[i] != EMPTY:
+                legal_masks[0][i] = legal_masks[1][i] = False
+                continue
+
+            # A point is legal if it has a liberty, connects to a group
+            # with another liberty, or captures a group with only one
+            legal = [False, False]
+            for adj_index in neighbours[i]:
+                adj_color = cells[adj_index]
+                if adj_color == EMPTY:
+                    legal = [True, True]
+                    break
+                if len(self._liberties[self._groups.find(adj_index)]) > 1:
+                    legal[adj_color] = True
+                else:
+                    legal[adj_color ^ 1] = True
+            if i == ko:
+                legal[self.current_color.value] = False
+
+            legal_masks[0][i], legal_masks[1][i] = legal
+
     def place_stone(self, pos):
         """
         Place a stone on the board at the specified position
+
+        Only the new stone, its neighbours and the groups they belong to
+        are examined, so the cost of a move does not depend on the number
+        of stones on the board
+
+        Raises IllegalMoveException if the position is not on the board
+        or is occupied, if the move is suicide or retakes a ko, or if the move
+        would repeat an earlier position (positional superko)
         """
-        new_stone = Stone(pos, self.current_color)
-        self.stones[pos] = new_stone
-        merge_groups = [new_stone.group]
-        for direction in Direction:
-            adj_pos = new_stone.pos + direction.value
-            if adj_pos in self.stones and self.stones[adj_pos].color == new_stone.color:
-                merge_groups += [self.stones[adj_pos].group]
+        pos = Position(*pos)
+        if not self.board.on_board(pos):
+            raise IllegalMoveException(f"{pos} is not on the board")
+        color = self.current_color
+        index = self.board.index(pos)
+        if not self._legal[color][index]:
+            if self.board.cells[index] != EMPTY:
+                raise IllegalMoveException(f"{pos} is already occupied")
+            if pos == self.ko_point:
+                raise IllegalMoveException(f"Playing at {pos} retakes a ko")
+            raise IllegalMoveException(f"Playing at {pos} is suicide")
+
+        new_hash = self._resulting_hash(index, color.value)
+        if new_hash in self._seen_hashes:
+            raise IllegalMoveException(f"Playing at {pos} repeats a position")
+
+        captures = self.play_unchecked(index, color)
+
+        # Truncates history for undos, in place
+        del self.history[self.history_position :]
+        # Stores the move, and the captures made, ko point and hash resulting from it,
+        # so that the move can be undone and redone
+        self.history += [
+            HistoryEntry(pos, color, captures, self.ko_point, self.position_hash)
+        ]
+        self._seen_hashes[self.position_hash] = (
+            self._seen_hashes.get(self.position_hash, 0) + 1
+        )
+
+        self.history_position += 1
+
+    def pass_turn(self):
+        """
+        Passes the turn to the other color, without placing a stone
+        """
+        color = self.current_color
+        self.pass_unchecked()
+
+        del self.history[self.history_position :]
+        self.history += [
+            HistoryEntry(None, color, dict(NO_CAPTURES), None, self.position_hash)
+        ]
+        self._seen_hashes[self.position_hash] += 1
+        self.history_position += 1
 
-        Group.merge(merge_groups)
-        captures = self.perform_captures()
+    def pass_unchecked(self):
+        """
+        Passes the turn, without recording history, so that it cannot be undone,
+        and without recording the position for positional superko
+
+        For playing games out quickly, see go.playout.Playout
+        """
+        self.ko_point = None
         self.toggle_color()
+        self._refresh_legality()
 
-        # Truncates history for undos
-        self.history = self.history[: self.history_position]
-        # Stores position and captures made
-        # Color is not stored, because it alternates, starting with black
-        self.history += [HistoryEntry(pos, captures)]
+    def play_unchecked(
+        self, index: int, color: Color
+    ) -> Dict[Color, Optional[Tuple[Position, ...]]]:
+        """
+        Places a stone of the given color at an index into the board,
+        performs captures and passes the turn, returning the positions captured
+        of each color, or None for a color with none captured
+
+        The move must be legal for the color, ignoring positional superko,
+        such as one in legal_mask, as it is not checked. The move is not recorded
+        in the history, so cannot be undone, nor is the position recorded
+        for positional superko. For playing games out quickly,
+        see go.playout.Playout
+        """
+        cells = self.board.cells
+        cells[index] = color.value
+        self.position_hash ^= self._zobrist[color.value][index]
+        self._groups.make_set(index)
+        self._changed.add(index)
+
+        root = index
+        liberties = set()
+        opponent_roots = []
+        for adj_index in self.board.neighbours[index]:
+            adj_color = cells[adj_index]
+            if adj_color == EMPTY:
+                liberties.add(adj_index)
+                continue
+
+            adj_root = self._groups.find(adj_index)
+            if adj_color != color.value:
+                if adj_root not in opponent_roots:
+                    opponent_roots += [adj_root]
+            elif adj_root != root:
+                # Merges the smaller set of liberties into the larger
+                adj_liberties = self._liberties.pop(adj_root)
+                if len(adj_liberties) > len(liberties):
+                    liberties, adj_liberties = adj_liberties, liberties
+                liberties |= adj_liberties
+                root = self._groups.union(root, adj_root)
+
+        liberties.discard(index)
+        self._liberties[root] = liberties
+        self._changed_roots[root] = None
+        for opponent_root in opponent_roots:
+            opponent_liberties = self._liberties[opponent_root]
+            self._changed_roots.setdefault(opponent_root, len(opponent_liberties))
+            opponent_liberties.discard(index)
+
+        captures = self.perform_captures(opponent_roots + [root])
+        self._count_prisoners(captures, 1)
+
+        # A single stone capturing a single stone, and left with one liberty,
+        # could be immediately recaptured, so the captured point is a ko point
+        self.ko_point = None
+        captured = captures[Color.WHITE if color == Color.BLACK else Color.BLACK]
+        if (
+            captured is not None
+            and len(captured) == 1
+            and self._groups.size[root] == 1
+            and len(liberties) == 1
+        ):
+            self.ko_point = captured[0]
 
+        self.current_color = color
+        self.toggle_color()
+        self._refresh_legality()
+
+        return captures
+
+    def undo(self) -> bool:
+        """
+        Undoes the last move, if there is one, returning whether a move was undone
+
+        Only the placed stone, the captured stones, and the groups adjacent
+        to them are modified, so undoing does not depend on the number of stones
+        on the board. It does grow with the size of the group the placed stone
+        joined, as that group is regrouped in case removing the stone splits it
+        """
+        if not self.history_position:
+            return False
+
+        self.history_position -= 1
+        entry = self.history[self.history_position]
+        count = self._seen_hashes.pop(entry.hash) - 1
+        if count:
+            self._seen_hashes[entry.hash] = count
+
+        if entry.pos is not None:
+            self._remove_stone(self.board.index(entry.pos))
+        for color, positions in entry.captures.items():
+            if positions is not None:
+                self._restore_stones(
+                    [self.board.index(pos) for pos in positions], color
+                )
+
+        self._count_prisoners(entry.captures, -1)
+        self.current_color = entry.color
+        self.ko_point = (
+            self.history[self.history_position - 1].ko_point
+            if self.history_position
+            else None
+        )
+        self._refresh_legality()
+
+        return True
+
+    def redo(self) -> bool:
+        """
+        Redoes the last undone move, if there is one, returning whether a move was redone
+        """
+        if self.history_position >= len(self.history):
+            return False
+
+        entry = self.history[self.history_position]
+        if entry.pos is None:
+            self.pass_unchecked()
+        else:
+            self.play_unchecked(self.board.index(entry.pos), entry.color)
+        self._seen_hashes[entry.hash] = self._seen_hashes.get(entry.hash, 0) + 1
         self.history_position += 1
 
+        return True
+
+    def _restore_stones(self, indices: List[int], color: Color):
+        # Puts back stones of a color that were removed from the board,
+        # taking away liberties from the groups adjacent to them
+        if not indices:
+            return
+
+        cells = self.board.cells
+        zobrist = self._zobrist[color.value]
+        for i in indices:
+            cells[i] = color.value
+            self.position_hash ^= zobrist[i]
+        self._changed.update(indices)
+        for i in indices:
+            for adj_index in self.board.neighbours[i]:
+                if cells[adj_index] not in (EMPTY, color.value):
+                    self._discard_liberty(self._groups.find(adj_index), i)
+        self._regroup(indices)
+
+    def _add_liberty(self, root: int, index: int):
+        liberties = self._liberties[root]
+        self._changed_roots.setdefault(root, len(liberties))
+        liberties.add(index)
+
+    def _discard_liberty(self, root: int, index: int):
+        liberties = self._liberties[root]
+        self._changed_roots.setdefault(root, len(liberties))
+        liberties.discard(index)
+
     def remove_stone(self, pos):
         """
-        Remove a stone from the board
+        Remove a stone from the board, freeing a liberty for adjacent groups
+
+        The rest of the stone's group is regrouped, as it may have been split
+        """
+        if not self.board.on_board(pos):
+            raise KeyError(pos)
+        index = self.board.index(pos)
+        if self.board.cells[index] == EMPTY:
+            raise KeyError(pos)
+
+        self._remove_stone(index)
+        self._refresh_legality()
+
+    def _remove_stone(self, index: int):
+        # Removes a stone, and regroups the rest of its group, which takes time
+        # proportional to the size of the group, as groups cannot be split
+        cells = self.board.cells
+        color = cells[index]
+        root = self._groups.find(index)
+        members = self._groups.members(root)
+        del self._liberties[root]
+        cells[index] = EMPTY
+        self.position_hash ^= self._zobrist[color][index]
+        self._changed.add(index)
+        for adj_index in self.board.neighbours[index]:
+            if cells[adj_index] not in (EMPTY, color):
+                self._add_liberty(self._groups.find(adj_index), index)
+
+        members.remove(index)
+        self._regroup(members)
+
+    def _remove_group(self, members: List[int]):
+        # Removes the stones of a group from the board,
+        # adding liberties to the groups adjacent to it
+        cells = self.board.cells
+        zobrist = self._zobrist[cells[members[0]]]
+        del self._liberties[self._groups.find(members[0])]
+        for i in members:
+            cells[i] = EMPTY
+            self.position_hash ^= zobrist[i]
+        self._changed.update(members)
+        for i in members:
+            for adj_index in self.board.neighbours[i]:
+                if cells[adj_index] != EMPTY:
+                    self._add_liberty(self._groups.find(adj_index), i)
+
+    def _regroup(self, indices: List[int]):
+        # Rebuilds the groups and liberties of the stones at the given indices,
+        # all of which are assumed to be disconnected from any other stones
+        cells = self.board.cells
+        neighbours = self.board.neighbours
+        for i in indices:
+            self._groups.make_set(i)
+        for i in indices:
+            for adj_index in neighbours[i]:
+                if cells[adj_index] == cells[i]:
+                    self._groups.union(i, adj_index)
+
+        for i in indices:
+            root = self._groups.find(i)
+            self._liberties[root] = set()
+            self._changed_roots[root] = None
+        for i in indices:
+            liberties = self._liberties[self._groups.find(i)]
+            for adj_index in neighbours[i]:
+                if cells[adj_index] == EMPTY:
+                    liberties.add(adj_index)
+
+    def _count_prisoners(
+        self, captures: Dict[Color, Optional[Tuple[Position, ...]]], sign: int
+    ):
+        # Adds (or subtracts, for undos) captured stones to the prisoners
+        # of the opposing color
+        for color, positions in captures.items():
+            if positions is not None:
+                self.prisoners[
+                    Color.WHITE if color == Color.BLACK else Color.BLACK
+                ] += sign * len(positions)
+
+    def ownership(self) -> np.ndarray:
         """
-        stone = self.stones[pos]
-        del self.stones[pos]
-        stone.group.stones.remove(stone)
+        The color owning each intersection, as a size x size array,
+        see the ownership function
 
-    def perform_captures(self) -> Dict[Color, Optional[Tuple[Position, ...]]]:
+        The result is cached against the position hash,
+        so should not be modified
         """
-        Performs any captures required in the current state of the board
+        if self._ownership is None or self._ownership[0] != self.position_hash:
+            board = np.frombuffer(self.board.cells, dtype=np.int8).reshape(
+                self.board_size, self.board_size
+            )
+            self._ownership = (self.position_hash, ownership(board))
+
+        return self._ownership[1]
+
+    def score(
+        self, method: ScoringMethod = ScoringMethod.AREA, komi: float = 0
+    ) -> Score:
         """
-        captures = {color: [] for color in Color}
-        for color in (
-            Color.WHITE if self.current_color == Color.BLACK else Color.BLACK,
-            self.current_color,
-        ):
-            self.update_liberties()
-            for group in self.groups[color]:
-                if group.can_capture:
-                    for stone in group:
-                        self.remove_stone(stone.pos)
-                        captures[stone.color] += [stone.pos]
+        Scores the game in its current state, with komi given to white
+
+        Every stone on the board is treated as alive
+        """
+        owners = self.ownership()
+        scores = {}
+        for color in (Color.BLACK, Color.WHITE):
+            scores[color] = int(np.count_nonzero(owners == color.value))
+            if method == ScoringMethod.TERRITORY:
+                scores[color] += self.prisoners[color] - self.board.cells.count(
+                    color.value
+                )
+
+        return Score(scores[Color.BLACK], scores[Color.WHITE] + komi)
+
+    def perform_captures(
+        self, roots: List[int]
+    ) -> Dict[Color, Optional[Tuple[Position, ...]]]:
+        """
+        Captures those of the groups with the given roots that have no liberties left
 
+        Groups are examined in order, so opponent groups should be given first,
+        as their capture may give liberties to the group of the stone just placed
+        """
+        captures = None
+        for root in roots:
+            if not self._liberties[root]:
+                if captures is None:
+                    captures = {color: [] for color in Color}
+                color = Color(self.board.cells[root])
+                # Stones are only enumerated once a group is actually captured
+                members = self._groups.members(root)
+                self._remove_group(members)
+                captures[color] += [self.board.position(i) for i in members]
+
+        if captures is None:
+            return dict(NO_CAPTURES)
         return {
             color: tuple(captures[color]) if captures[color] else None
             for color in Color
@@ -265,23 +1171,46 @@ class GameState:
 
     def update_liberties(self):
         """
-        Updates the liberties of each stone
+        Recomputes the groups and their liberties from scratch
+
+        This walks the whole board, and is only needed if ``board``
+        has been modified directly, rather than through ``place_stone``
         """
-        for stone in self.stones.values():
-            for direction in Direction:
-                adj_pos = stone.pos + direction.value
-                if (0, 0) <= adj_pos <= 2 * (
-                    self.board_size - 1,
-                ) and adj_pos not in self.stones:
-                    stone.liberties[direction] = True
-                else:
-                    stone.liberties[direction] = False
+        self._liberties.clear()
+        self._regroup([i for i, color in enumerate(self.board.cells) if color != EMPTY])
+        self._changed.update(range(self.board_size ** 2))
+        self._refresh_legality()
 
 
 class ClientState:
     def __init__(self):
-        self.board_size = None
-        self.stones = {}
+        self.board = None
+        # Id of the game, and sequence number of the last move on the board,
+        # see protocol.rst
+        self.game = None
+        self.seq = None
         self.color = None
         self.turn = False
         self._outgoing_event_q = asyncio.Queue()
+
+    @property
+    def board_size(self) -> Optional[int]:
+        return self.board.size if self.board is not None else None
+
+    @property
+    def stones(self) -> Mapping:
+        return StonesView(self.board) if self.board is not None else {}
+
+    def place(self, stone: Stone):
+        """
+        Places a stone sent by the server on the board
+        """
+        self.board.cells[self.board.index(stone.pos)] = stone.color.value
+        self.seq += 1
+
+    def remove(self, positions: Iterable[Position]):
+        """
+        Removes stones captured, as sent by the server, from the board
+        """
+        for pos in positions:
+            self.board.cells[self.board.index(pos)] = EMPTY
@@ -1,12 +1,140 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-from typing import Any, Tuple, Dict
+import math
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
-from .errors import ConnectionTimeoutError, DataException
-from .models import Color, Mode, Position, Stone
+from .codecs import deserialize, encode_varint, serialize
+from .errors import ConnectionCloseException, ConnectionTimeoutError, DataException
 
 DEFAULT_PORT = 18255
+BINARY_OPTION = "binary"  # Handshake option selecting binary framing
+READ_BUFFER_SIZE = 2048  # Initial size of the buffer of received data
+MIN_READ_SIZE = 1024  # Least free space in the buffer offered to the transport
+MAX_FRAME_SIZE = 64 * 1024  # Largest message accepted
+MAX_LENGTH_SIZE = len(encode_varint(MAX_FRAME_SIZE))  # Longest length in binary
+READ_HIGH_WATER = 2 * MAX_FRAME_SIZE  # Data received before reading is paused
+DEFAULT_TICK = 0.5  # Seconds between checks of a TimerWheel
+DEFAULT_SLOTS = 128
+
+
+class TimerWheel:
+    """
+    Expires items, such as connections, once their deadlines have passed,
+    checking them all from a single periodic callback,
+    rather than with a timer for each of them
+
+    Items have a ``deadline`` method, returning the loop time at which
+    they expire, or None if they do not, and an ``expire`` method.
+    Items are kept in the slot of the tick of their deadline, and deadlines
+    may change freely, as an item whose deadline has not yet passed when its slot
+    is checked is moved to the slot of its new deadline
+    """
+
+    def __init__(self, tick: float = DEFAULT_TICK, slots: int = DEFAULT_SLOTS):
+        self.tick = tick
+        self._slots: List[Set[Any]] = [set() for _ in range(slots)]
+        self._slot_of: Dict[Any, int] = {}
+        # The slot checked last, and the time it was checked
+        self._current = 0
+        self._time = 0.0
+        self._handle = None
+
+    def start(self):
+        """
+        Starts checking deadlines, on the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        self._time = loop.time()
+        self._handle = loop.call_at(self._time + self.tick, self._advance)
+
+    def stop(self):
+        """
+        Stops checking deadlines
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def add(self, item):
+        """
+        Adds an item, or moves it to the slot of its current deadline
+        """
+        self.discard(item)
+        deadline = item.deadline()
+        if deadline is None:
+            return
+
+        # Deadlines further away than the wheel goes round are checked early
+        ticks = math.ceil((deadline - self._time) / self.tick)
+        slot = (self._current + min(max(ticks, 1), len(self._slots) - 1)) % len(
+            self._slots
+        )
+        self._slots[slot].add(item)
+        self._slot_of[item] = slot
+
+    def discard(self, item):
+        """
+        Removes an item, if it has been added
+        """
+        slot = self._slot_of.pop(item, None)
+        if slot is not None:
+            self._slots[slot].discard(item)
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def _advance(self):
+        # Checks the items in each slot whose tick has passed,
+        # going round the wheel at most once if the loop has fallen behind
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        for _ in range(len(self._slots)):
+            if self._time + self.tick > now:
+                break
+            self._current = (self._current + 1) % len(self._slots)
+            self._time += self.tick
+            items, self._slots[self._current] = self._slots[self._current], set()
+            for item in items:
+                del self._slot_of[item]
+                deadline = item.deadline()
+                if deadline is not None and deadline <= now:
+                    item.expire()
+                else:
+                    self.add(item)
+        else:
+            self._time = now
+
+        self._handle = loop.call_at(self._time + self.tick, self._advance)
+
+
+class TokenBucket:
+    """
+    Limits the rate of events to ``rate`` per second on average,
+    while allowing bursts of up to ``burst`` events
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._time = None
+
+    def take(self, now: float) -> float:
+        """
+        Takes a token for an event at the given time, returning the number
+        of seconds to wait before the event is within the rate, if any
+
+        Tokens are taken in advance, so an event that has to wait
+        should go ahead after waiting, without taking another
+        """
+        if self._time is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._time) * self.rate
+            )
+        self._time = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
 
 
 class ClientServerBase:
@@ -19,109 +147,299 @@ class ClientServerBase:
         self.port = port if port else DEFAULT_PORT
 
 
-class ConnectionBase:
+class ConnectionBase(asyncio.BufferedProtocol):
     """
     Common for both client and server connections
+
+    Data is received directly into a reusable buffer, and messages are parsed
+    out of it as they are received with recv, rather than as data arrives,
+    so that the framing can change between messages. The buffer is allocated
+    on the first read, and grows as needed, and reading is paused while
+    more than ``READ_HIGH_WATER`` bytes are waiting to be parsed
     """
 
-    def __init__(self, reader, writer, timeout=None):
-        self.reader = reader
-        self.writer = writer
+    def __init__(self, timeout=None):
         self.timeout = timeout
+        self.transport = None
+        # Whether binary framing has been selected in the handshake
+        self.binary = False
+
+        # Received data not yet parsed is in _read_buffer[_read_start:_read_end]
+        self._read_buffer = bytearray()
+        self._read_start = self._read_end = 0
+        # The reasons reading from the transport is paused, see pause_reading
+        self._read_paused: Set[str] = set()
+        self._eof = False
+        self._exception = None
+        # Future waiting for more data, the time data was last waited for
+        # or received, and the timer checking that the connection is not idle
+        self._read_waiter = None
+        self._last_activity = 0.0
+        self._idle_timer = None
+
+        # Messages queued for sending, and the callback writing them
+        self._write_buffer = bytearray()
+        self._write_handle = None
+        # Whether the transport has asked for writing to be paused,
+        # and the future waiting for it to resume
+        self._write_paused = False
+        self._drain_waiter = None
+        self._closed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        start, end = self._read_start, self._read_end
+        if start == end:
+            self._read_start = self._read_end = start = end = 0
+
+        free = max(sizehint, MIN_READ_SIZE)
+        if len(self._read_buffer) - end < free:
+            pending = end - start
+            if len(self._read_buffer) - pending < free:
+                # Copied into a new buffer, so any views of the old one stay valid
+                buffer = bytearray(
+                    max(2 * len(self._read_buffer), pending + free, READ_BUFFER_SIZE)
+                )
+                buffer[:pending] = self._read_buffer[start:end]
+                self._read_buffer = buffer
+            else:
+                self._read_buffer[:pending] = self._read_buffer[start:end]
+            self._read_start, self._read_end = 0, pending
+
+        return memoryview(self._read_buffer)[self._read_end :]
+
+    def buffer_updated(self, nbytes: int):
+        self._read_end += nbytes
+        self._last_activity = asyncio.get_running_loop().time()
+        if self._read_end - self._read_start > READ_HIGH_WATER:
+            self.pause_reading("buffer")
+        self._wake_reader()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._eof = True
+        if exc is not None:
+            self._exception = ConnectionCloseException(str(exc))
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        self._wake_reader()
+        self.resume_writing()
+        if not self._closed.done():
+            self._closed.set_result(None)
 
-    def _serialize(self, key: str = "", value: Any = None) -> str:
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def pause_reading(self, reason: str):
+        """
+        Pauses reading from the transport for the given reason,
+        until reading is resumed for every reason it was paused for
+        """
+        if not self._read_paused and self.transport is not None:
+            self.transport.pause_reading()
+        self._read_paused.add(reason)
+
+    def resume_reading(self, reason: str):
+        """
+        Resumes reading from the transport, if it was paused for the given reason,
+        and for no other, see pause_reading
+        """
+        if reason not in self._read_paused:
+            return
+        self._read_paused.discard(reason)
+        if not self._read_paused and self.transport is not None:
+            self.transport.resume_reading()
+
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    def _check_idle(self):
+        # Times out a read waiting for longer than the timeout since data was
+        # last received, otherwise rescheduling itself for when that would be
+        self._idle_timer = None
+        if self._read_waiter is None or self._read_waiter.done():
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = self._last_activity + self.timeout
+        if loop.time() < deadline:
+            self._idle_timer = loop.call_at(deadline, self._check_idle)
+        else:
+            self._read_waiter.set_exception(ConnectionTimeoutError("Timeout exceeded."))
+
+    async def _wait_for_data(self):
+        loop = asyncio.get_running_loop()
+        self._read_waiter = loop.create_future()
+        self._last_activity = loop.time()
+        if self.timeout is not None and self._idle_timer is None:
+            self._idle_timer = loop.call_at(
+                self._last_activity + self.timeout, self._check_idle
+            )
+        try:
+            await self._read_waiter
+        finally:
+            self._read_waiter = None
+
+    def _next_frame(self) -> Optional[memoryview]:
+        # A view of the next message received, without its framing,
+        # or None if it has not been received in full
+        buffer, start, end = self._read_buffer, self._read_start, self._read_end
+        if not self.binary:
+            newline = buffer.find(b"\n", start, end)
+            if newline < 0:
+                if end - start > MAX_FRAME_SIZE:
+                    raise DataException("Message too long")
+                return None
+            self._read_start = newline + 1
+            return memoryview(buffer)[start:newline]
+
+        length = shift = 0
+        offset = start
+        while True:
+            if offset - start == MAX_LENGTH_SIZE:
+                raise DataException("Message too long")
+            if offset == end:
+                return None
+            byte = buffer[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+
+        if length > MAX_FRAME_SIZE:
+            raise DataException("Message too long")
+        if end - offset < length:
+            return None
+        self._read_start = offset + length
+        return memoryview(buffer)[offset : offset + length]
+
+    def _serialize(self, key: str = "", value: Any = None) -> bytes:
         # Serializes data for transmission
-        serialized = ""
-        if key in ("go", "ok"):
-            serialized = f"{value}"
-        elif key == "mode":
-            serialized = f"{value.name.upper()}"
-        elif key == "stones":
-            stones, board_size = value
-            serialized = ""
-            for y in range(board_size):
-                for x in range(board_size):
-                    pos = Position(x, y)
-                    if pos not in stones:
-                        serialized += "X"
-                    else:
-                        stone = stones[pos]
-                        serialized += self._serialize(value=stone.color)
-        elif key == "color":
-            serialized = f"{value.value}"
-
-        return f"{f'{key} ' if key else ''}{serialized}\n"
-
-    def _deserialize(self, data: str) -> Tuple[str, Any]:
+        return serialize(key, value, self.binary)
+
+    def _deserialize(self, data: memoryview) -> Tuple[str, Any]:
         # Deserializes data for transmission
-        key, *value = data.split(maxsplit=1)
-        if not value:
-            return (key, None)
-        value = value[0]
-        if key in ("ok", "go"):
-            return (key, value)
-        if key == "mode":
-            if value not in Mode.__members__:
-                raise DataException(f"{value!r} is not a valid mode")
-            return (key, Mode[value])
-
-        if key == "stones":
-            if len(value) not in (81, 169, 361):
-                raise DataException(
-                    f"Invalid number of stones represented, got {len(value)}"
-                )
+        return deserialize(data, self.binary)
 
-            board_size = int(len(value) ** 0.5)
-            stones = {}
-            for y in range(board_size):
-                for x in range(board_size):
-                    stone_char = value[y * board_size + x]
-                    if stone_char.upper() == "X":
-                        continue
-                    color = self._deserialize(f"color {stone_char}")
-                    pos = Position(x, y)
-                    stones[pos] = Stone(pos, color)
-
-            return (key, (stones, board_size))
-        if key == "color":
-            try:
-                color_value = int(value)
-            except ValueError:
-                raise DataException(
-                    f"{value!r} is not a valid representation of a integer"
-                )
+    def queue(self, key, value=None):
+        """
+        Queues data to be sent, see send. Queued data is written together,
+        either on flush, or on the next iteration of the event loop
+        """
+        self.queue_data(self._serialize(key, value))
+
+    def queue_data(self, data: bytes):
+        """
+        Queues data already serialized with the framing of the connection
+        """
+        self._write_buffer += data
+        if self._write_handle is None:
+            self._write_handle = asyncio.get_running_loop().call_soon(
+                self._write_queued
+            )
 
+    def _write_queued(self):
+        # Writes all the queued data to the transport at once
+        if self._write_handle is not None:
+            self._write_handle.cancel()
+            self._write_handle = None
+        if self._write_buffer:
+            if self.transport is not None and not self.transport.is_closing():
+                self.transport.write(bytes(self._write_buffer))
+            self._write_buffer.clear()
+
+    @property
+    def write_buffer_size(self) -> int:
+        """
+        The number of bytes queued or buffered by the transport, but not yet sent
+        """
+        buffered = self.transport.get_write_buffer_size() if self.transport else 0
+        return len(self._write_buffer) + buffered
+
+    async def flush(self):
+        """
+        Writes all queued data, waiting only if the transport's buffer
+        is above its high-water mark
+        """
+        self._write_queued()
+        if self._write_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
             try:
-                return (key, Color(color_value))
-            except ValueError:
-                raise DataException(f"{color_value} is not a valid color value")
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+        if self._closed is not None and self._closed.done():
+            raise ConnectionCloseException("Connection closed")
 
     async def send(self, key, value=None):
         """
-        Sends data according with the given key, and optionally an associated value
+        Sends data according with the given key, and optionally an associated value,
+        along with any data queued
         """
-        data = self._serialize(key, value)
-        self.writer.write(data.encode())
-        await self.writer.drain()
+        self.queue(key, value)
+        await self.flush()
+
+    async def send_many(self, messages: Iterable[Tuple[str, Any]]):
+        """
+        Sends several messages, as pairs of key and value, in a single write
+        """
+        for key, value in messages:
+            self.queue(key, value)
+        await self.flush()
 
     async def recv(self, *keys) -> Dict[str, Any]:
         """
         Receives data, expecting the key to be one of those specified
+
+        Raises ConnectionTimeoutError if no data is received for longer
+        than the timeout while waiting
         """
+        while True:
+            frame = self._next_frame()
+            if frame is not None:
+                break
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                raise ConnectionCloseException("Connection closed")
+            self.resume_reading("buffer")
+            await self._wait_for_data()
+
         try:
-            data = await asyncio.wait_for(
-                self.reader.readuntil(b"\n"), timeout=self.timeout
-            )
-            key, value = self._deserialize(data[:-1].decode())
-            if keys and key not in keys:
-                raise DataException(f"Expected key to be one of {keys}, got {key!r}")
-            return {key: value}
-        except asyncio.TimeoutError:
-            raise ConnectionTimeoutError("Timeout exceeded.")
+            key, value = self._deserialize(frame)
+        finally:
+            frame.release()
+        if keys and key not in keys:
+            raise DataException(f"Expected key to be one of {keys}, got {key!r}")
+        return {key: value}
+
+    def abort(self):
+        """
+        Closes the connection immediately, discarding any data not yet sent
+        """
+        self._write_buffer.clear()
+        if self.transport is not None:
+            self.transport.abort()
 
     async def close(self):
         """
-        Closes the connection
+        Closes the connection, after writing any data queued
         """
-        self.writer.close()
-        await self.writer.wait_closed()
+        self._write_queued()
+        if self.transport is not None:
+            self.transport.close()
+            await self._closed
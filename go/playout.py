@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless engine for playing games out to the end with random moves
+"""
+
+import os
+import random
+from array import array
+from collections import namedtuple
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .models import EMPTY, Board, Color, GameState, Position
+
+# Result of a playout, with ``moves`` being the positions played,
+# None for a pass, if the moves were recorded
+PlayoutResult = namedtuple("PlayoutResult", "winner score ownership moves")
+# Aggregated results of many playouts. ``ownership`` is, for each intersection,
+# the proportion of playouts in which black owned it, minus that for white
+PlayoutStats = namedtuple("PlayoutStats", "playouts wins draws ownership")
+
+
+@lru_cache(maxsize=None)
+def diagonal_table(board_size: int) -> Tuple[Tuple[int, ...], ...]:
+    """
+    For each index into a flat board of the given size,
+    the indices of the diagonally adjacent intersections that are on the board
+    """
+    table = []
+    for i in range(board_size ** 2):
+        y, x = divmod(i, board_size)
+        table += [
+            tuple(
+                (y + dy) * board_size + x + dx
+                for dx in (-1, 1)
+                for dy in (-1, 1)
+                if 0 <= x + dx < board_size and 0 <= y + dy < board_size
+            )
+        ]
+
+    return tuple(table)
+
+
+def is_eye(
+    board: Board, diagonals: Tuple[Tuple[int, ...], ...], i: int, color: int
+) -> bool:
+    """
+    Whether an empty intersection is an eye of the given color value:
+    surrounded by its stones, with enough of the diagonals also controlled
+
+    ``diagonals`` is the diagonal_table for the size of the board
+    """
+    cells = board.cells
+    for adj_index in board.neighbours[i]:
+        if cells[adj_index] != color:
+            return False
+
+    opponent = sum(1 for j in diagonals[i] if cells[j] == color ^ 1)
+    # Diagonals off the board count against the eye
+    return opponent + (len(diagonals[i]) < 4) < 2
+
+
+class Playout:
+    """
+    Plays a game out from a position until both players pass,
+    choosing uniformly at random from the legal moves that do not fill
+    one of the player's own eyes
+
+    The game state is copied, so the position given is not modified.
+    History and positional superko are not tracked during the playout
+    """
+
+    def __init__(
+        self,
+        game_state: GameState,
+        rng: Optional[random.Random] = None,
+        komi: float = 0,
+        max_moves: Optional[int] = None,
+        record: bool = False,
+    ):
+        self.game_state = GameState.from_board(
+            game_state.board, game_state.current_color, game_state.ko_point
+        )
+        self.rng = rng if rng is not None else random.Random()
+        self.komi = komi
+        # Long cycles are possible without superko, so the number of moves is capped
+        self.max_moves = (
+            max_moves if max_moves is not None else 3 * game_state.board_size ** 2
+        )
+        self.record = record
+
+        # The empty intersections, in no particular order,
+        # and the position of each index in that list
+        board_size = game_state.board_size
+        self._empty: List[int] = [
+            i for i, color in enumerate(game_state.board.cells) if color == EMPTY
+        ]
+        self._empty_position = [0] * board_size ** 2
+        for j, i in enumerate(self._empty):
+            self._empty_position[i] = j
+        self._diagonals = diagonal_table(board_size)
+        # Views of the legal moves of each color, which are kept up to date
+        self._legal = {
+            color: self.game_state.legal_mask(color)
+            for color in (Color.BLACK, Color.WHITE)
+        }
+
+    def _add_empty(self, i: int):
+        self._empty_position[i] = len(self._empty)
+        self._empty += [i]
+
+    def _remove_empty(self, i: int):
+        j = self._empty_position[i]
+        last = self._empty.pop()
+        if last != i:
+            self._empty[j] = last
+            self._empty_position[last] = j
+
+    def _choose_move(self, color: Color) -> Optional[int]:
+        # Picks a random legal move that does not fill an eye, by sampling
+        # the empty intersections, and moving each rejected one to the end
+        # of the list so it is not sampled again
+        empty = self._empty
+        empty_position = self._empty_position
+        legal = self._legal[color]
+        board = self.game_state.board
+        diagonals = self._diagonals
+        randrange = self.rng.randrange
+        remaining = len(empty)
+        while remaining:
+            j = randrange(remaining)
+            i = empty[j]
+            if legal[i] and not is_eye(board, diagonals, i, color.value):
+                return i
+
+            remaining -= 1
+            last = empty[remaining]
+            empty[j], empty[remaining] = last, i
+            empty_position[last], empty_position[i] = j, remaining
+
+        return None
+
+    def run(self) -> PlayoutResult:
+        """
+        Plays the game out to the end, and scores it by area
+        """
+        game_state = self.game_state
+        board = game_state.board
+        moves = []
+        passes = 0
+        for _ in range(self.max_moves):
+            color = game_state.current_color
+            i = self._choose_move(color)
+            if i is None:
+                game_state.pass_unchecked()
+                passes += 1
+                if passes == 2:
+                    break
+            else:
+                passes = 0
+                captures = game_state.play_unchecked(i, color)
+                self._remove_empty(i)
+                for positions in captures.values():
+                    if positions is not None:
+                        for pos in positions:
+                            self._add_empty(board.index(pos))
+
+            if self.record:
+                moves += [None if i is None else board.position(i)]
+
+        return self.result(moves if self.record else None)
+
+    def result(self, moves: Optional[List[Position]] = None) -> PlayoutResult:
+        """
+        Scores the game by area, as it currently stands
+        """
+        score = self.game_state.score(komi=self.komi)
+        if score.black == score.white:
+            winner = None
+        else:
+            winner = Color.BLACK if score.black > score.white else Color.WHITE
+
+        return PlayoutResult(winner, score, self.game_state.ownership(), moves)
+
+
+def playout(
+    game_state: GameState,
+    rng: Optional[random.Random] = None,
+    komi: float = 0,
+    record: bool = False,
+) -> PlayoutResult:
+    """
+    Plays a game out to the end with random moves, see Playout
+    """
+    return Playout(game_state, rng=rng, komi=komi, record=record).run()
+
+
+def _run_playouts(
+    cells: bytes,
+    board_size: int,
+    color: int,
+    ko_index: Optional[int],
+    playouts: int,
+    seed: int,
+    komi: float,
+) -> Tuple[int, int, int, np.ndarray]:
+    # Runs playouts in a worker process, from a position shipped as the raw
+    # cells of its board, returning black and white wins, draws,
+    # and the sum over the playouts of black minus white ownership
+    board = Board(board_size, array("b", cells))
+    game_state = GameState.from_board(
+        board, Color(color), None if ko_index is None else board.position(ko_index)
+    )
+    rng = random.Random(seed)
+    wins = {Color.BLACK: 0, Color.WHITE: 0, None: 0}
+    ownership = np.zeros((board_size, board_size), dtype=np.int32)
+    for _ in range(playouts):
+        result = Playout(game_state, rng=rng, komi=komi).run()
+        wins[result.winner] += 1
+        ownership += result.ownership == Color.BLACK.value
+        ownership -= result.ownership == Color.WHITE.value
+
+    return wins[Color.BLACK], wins[Color.WHITE], wins[None], ownership
+
+
+class ProcessPoolBase:
+    """
+    Common base for running work across a pool of ``workers`` processes,
+    one per CPU by default, or the given executor
+
+    The pool is kept between runs, and can be shut down by using this
+    as a context manager, or with ``shutdown``
+    """
+
+    def __init__(
+        self, workers: Optional[int] = None, executor: Optional[Executor] = None
+    ):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self._own_executor = executor is None
+        self.executor = (
+            executor if executor is not None else ProcessPoolExecutor(self.workers)
+        )
+
+    def shutdown(self):
+        """
+        Shuts down the process pool, if it was created by this
+        """
+        if self._own_executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class ParallelPlayoutRunner(ProcessPoolBase):
+    """
+    Runs many playouts from a position across a pool of processes,
+    and aggregates their results
+
+    Positions are sent to the workers as the raw bytes of the board,
+    rather than as pickled game states
+    """
+
+    def run(
+        self,
+        game_state: GameState,
+        playouts: int,
+        komi: float = 0,
+        seed: Optional[int] = None,
+        chunks_per_worker: int = 4,
+    ) -> PlayoutStats:
+        """
+        Plays ``playouts`` random games to completion from the given position
+
+        Playouts are split into several chunks per worker,
+        so that workers finishing early can pick up more of them
+        """
+        rng = random.Random(seed)
+        chunks = max(1, min(playouts, self.workers * chunks_per_worker))
+        ko_index = (
+            None
+            if game_state.ko_point is None
+            else game_state.board.index(game_state.ko_point)
+        )
+        cells = game_state.board.cells.tobytes()
+        futures = [
+            self.executor.submit(
+                _run_playouts,
+                cells,
+                game_state.board_size,
+                game_state.current_color.value,
+                ko_index,
+                playouts // chunks + (i < playouts % chunks),
+                rng.getrandbits(64),
+                komi,
+            )
+            for i in range(chunks)
+        ]
+
+        wins = {Color.BLACK: 0, Color.WHITE: 0}
+        draws = 0
+        ownership = np.zeros((game_state.board_size,) * 2, dtype=np.int64)
+        for future in futures:
+            black_wins, white_wins, chunk_draws, chunk_ownership = future.result()
+            wins[Color.BLACK] += black_wins
+            wins[Color.WHITE] += white_wins
+            draws += chunk_draws
+            ownership += chunk_ownership
+
+        return PlayoutStats(playouts, wins, draws, ownership / max(playouts, 1))
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+Games hosted by the server, each in its own room
+"""
+
+import asyncio
+import hashlib
+import random
+from bisect import bisect
+from collections import deque
+from itertools import islice
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .models import Color, GameState, Mode, Position, Stone
+
+DEFAULT_MAX_DELTA = 64  # Number of moves kept for bringing clients up to date
+DEFAULT_REPLICAS = 64  # Points on the hash ring for each node
+DEFAULT_INBOUND_SIZE = 64  # Moves waiting to be played before clients are paused
+GAME_ID_BITS = 32
+MAX_ROOM_ID_LENGTH = 64
+
+
+def _stable_hash(key: str) -> int:
+    # Unlike hash, the same in every process
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of room ids to the nodes numbered ``0`` to ``nodes - 1``,
+    so that every process agrees on which node owns a room
+
+    Each node is placed at several points on a ring of hashes,
+    and a room is owned by the node at the first point after the room's hash
+    """
+
+    def __init__(self, nodes: int, replicas: int = DEFAULT_REPLICAS):
+        points = sorted(
+            (_stable_hash(f"{node}:{replica}"), node)
+            for node in range(nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, room_id: str) -> int:
+        """
+        The node owning the room with the given id
+        """
+        return self._nodes[
+            bisect(self._hashes, _stable_hash(room_id)) % len(self._nodes)
+        ]
+
+
+class MoveLog:
+    """
+    The most recent moves of a game, for bringing a client's board up to date
+    by sending only the moves it is missing, rather than the whole board
+
+    Moves are numbered by a sequence number, which is the number of stones
+    placed in the game, see protocol.rst
+    """
+
+    def __init__(self, max_moves: int = DEFAULT_MAX_DELTA):
+        self.seq = 0
+        # The messages of each move, from the oldest kept
+        self._moves = deque(maxlen=max_moves)
+
+    def record(self, stone: Stone, captured: List[Position]) -> List[Tuple[str, Any]]:
+        """
+        Records a stone being placed, and the stones captured by it,
+        returning the messages describing the move
+        """
+        messages = [("place", stone)]
+        if captured:
+            messages += [("remove", captured)]
+        self.seq += 1
+        self._moves.append(messages)
+        return messages
+
+    def since(self, seq: Optional[int]) -> Optional[List[Tuple[str, Any]]]:
+        """
+        The messages of the moves after the given sequence number,
+        or None if they are no longer kept, or the sequence number is unknown
+        """
+        if seq is None or not self.seq - len(self._moves) <= seq <= self.seq:
+            return None
+        moves = islice(self._moves, len(self._moves) - (self.seq - seq), None)
+        return [message for messages in moves for message in messages]
+
+
+class Room:
+    """
+    A single game hosted by the server, and the seats of its players
+
+    A local game has a single seat, whose client plays both colors,
+    and a normal game has a seat for each color. Any number of clients
+    may watch the game as spectators
+    """
+
+    def __init__(
+        self,
+        room_id: str,
+        board_size: int,
+        mode: Mode,
+        inbound_size: int = DEFAULT_INBOUND_SIZE,
+    ):
+        self.id = room_id
+        self.mode = mode
+        # Distinguishes the game from others played in rooms with the same id,
+        # see protocol.rst
+        self.game = random.getrandbits(GAME_ID_BITS)
+        self.game_state = GameState(board_size)
+        self.log = MoveLog()
+        colors = (Color.BLACK,) if mode == Mode.LOCAL else (Color.BLACK, Color.WHITE)
+        self.seats: Dict[Color, Any] = {color: None for color in colors}
+        # Connections of the players and spectators, which are sent each move
+        self.subscribers: Set[Any] = set()
+        # Moves requested by clients, as pairs of connection and position,
+        # waiting to be played by the task of the room
+        self.inbound = asyncio.Queue(maxsize=inbound_size)
+        self.task = None
+
+    def seat(self, connection) -> Optional[Color]:
+        """
+        Seats the connection in the first free seat, returning its color,
+        or None if all the seats are taken
+        """
+        for color, occupant in self.seats.items():
+            if occupant is None:
+                self.seats[color] = connection
+                self.subscribers.add(connection)
+                return color
+
+        return None
+
+    def watch(self, connection):
+        """
+        Adds the connection as a spectator
+        """
+        self.subscribers.add(connection)
+
+    def leave(self, connection):
+        """
+        Frees the seat of the connection, if it has one,
+        and stops sending it moves
+        """
+        for color, occupant in self.seats.items():
+            if occupant is connection:
+                self.seats[color] = None
+        self.subscribers.discard(connection)
+
+    def to_play(self):
+        """
+        The connection of the player whose turn it is, or None if the seat is free
+        """
+        if self.mode == Mode.LOCAL:
+            return self.seats[Color.BLACK]
+        return self.seats[self.game_state.current_color]
+
+    @property
+    def empty(self) -> bool:
+        """
+        Whether there are no players or spectators
+        """
+        return not self.subscribers
+
+    def restore(self, game_state: GameState, seq: int):
+        """
+        Replaces the game with one restored after the move
+        with the given sequence number, such as from a snapshot
+        """
+        self.game_state = game_state
+        self.log = MoveLog()
+        self.log.seq = seq
+
+    def play(self, pos: Position) -> List[Tuple[str, Any]]:
+        """
+        Places a stone for the player whose turn it is, returning the messages
+        describing the move, to be sent to the clients
+
+        Raises IllegalMoveException if the move is not legal
+        """
+        game_state = self.game_state
+        color = game_state.current_color
+        game_state.place_stone(pos)
+        captured = [
+            captured_pos
+            for positions in game_state.history[-1].captures.values()
+            if positions is not None
+            for captured_pos in positions
+        ]
+        return self.log.record(Stone(Position(*pos), color), captured)
+
+    def __repr__(self):
+        return f"Room(id={self.id!r}, mode={self.mode})"
@@ -1,13 +1,74 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import multiprocessing
+import os
+import signal
+from itertools import count
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from . import __version__
-from .errors import DataException
-from .models import GameState
-from .networking import ClientServerBase, ConnectionBase
+from .codecs import serialize
+from .errors import (
+    ConnectionException,
+    ConnectionTimeoutError,
+    DataException,
+    IllegalMoveException,
+    ServerFullException,
+    VersionException,
+)
+from .journal import Journal, replay
+from .models import Mode, Position
+from .networking import (
+    BINARY_OPTION,
+    DEFAULT_PORT,
+    ClientServerBase,
+    ConnectionBase,
+    TimerWheel,
+    TokenBucket,
+)
+from .rooms import MAX_ROOM_ID_LENGTH, HashRing, Room
 
 DEFAULT_HOST = "0.0.0.0"
+DEFAULT_HIGH_WATER = 256 * 1024  # Bytes waiting for a client before it is dropped
+DEFAULT_HANDSHAKE_TIMEOUT = 10  # Seconds from connecting to completing the handshake
+DEFAULT_SETUP_TIMEOUT = 30  # Seconds from the handshake to completing the setup
+DEFAULT_MAX_PENDING = 1024  # Connections yet to complete the setup
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_MAX_ROOMS = 10000
+DEFAULT_MESSAGE_RATE = 10  # Messages per second from each client, on average
+DEFAULT_MESSAGE_BURST = 20  # Messages a client may send at once
+DEFAULT_RECOVERY_GRACE = 300  # Seconds a recovered room is kept for its clients
+INTERNAL_HOST = "127.0.0.1"  # Host of the listeners for connections between workers
+DEFAULT_INTERNAL_PORT = DEFAULT_PORT + 1  # Internal port of the first worker
+
+_FULL_MESSAGE = serialize("full")
+
+
+class Relay(asyncio.Protocol):
+    """
+    Connection from a worker to the worker owning the room a client joined,
+    relaying data between it and the client's connection
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.connection.transport.write(data)
+
+    def connection_lost(self, exc):
+        self.connection.transport.close()
+
+    def pause_writing(self):
+        self.connection.transport.pause_reading()
+
+    def resume_writing(self):
+        self.connection.transport.resume_reading()
 
 
 class Connection(ConnectionBase):
@@ -15,9 +76,98 @@ class Connection(ConnectionBase):
     Represents the server's connection to a client
     """
 
-    def __init__(self, server, reader, writer, timeout=None):
-        super().__init__(reader, writer, timeout=timeout)
+    def __init__(self, server, timeout=None, forwarded=False):
+        super().__init__(timeout=timeout)
         self.server = server
+        self.id = None  # Assigned by the server
+        # Whether the connection is forwarded from another worker,
+        # and the transport of the relay to the worker owning the room
+        # the client joined, if it is not this one
+        self.forwarded = forwarded
+        self._relay = None
+        # The room joined, and the color of the seat taken in it
+        self.room = None
+        self.color = None
+        # Whether the setup is complete, and until then, the time by which
+        # the handshake or setup must be complete
+        self.established = False
+        self._phase_deadline = None
+        # Data broadcast to the room before the setup is complete,
+        # sent once it is, see hold
+        self._held = bytearray()
+
+    def deadline(self) -> Optional[float]:
+        """
+        The loop time at which the connection expires, see TimerWheel
+
+        Until the setup is complete, this is the deadline of the handshake or setup,
+        and after, the time the server's idle timeout runs out from the last
+        data received. Relayed connections are left to the worker relayed to
+        """
+        if self._relay is not None:
+            return None
+        if not self.established:
+            return self._phase_deadline
+        if self.server.idle_timeout is None:
+            return None
+        return self._last_activity + self.server.idle_timeout
+
+    def expire(self):
+        """
+        Closes the connection for having taken too long
+        """
+        self._exception = ConnectionTimeoutError("Timeout exceeded.")
+        self.abort()
+
+    def reject(self):
+        """
+        Tells the client the server is full, and closes the connection,
+        without a handshake
+        """
+        self.transport.write(_FULL_MESSAGE)
+        self.transport.close()
+
+    def hold(self, data: bytes):
+        """
+        Holds data broadcast to the connection's room until the setup
+        is complete, so that it is not sent in the middle of the setup.
+        Data held when the client syncs is discarded, as the board sent
+        to the client includes it
+        """
+        self._held += data
+
+    def _start_phase(self, timeout: float):
+        # Starts the handshake or setup, which must be complete within the timeout
+        self._phase_deadline = asyncio.get_running_loop().time() + timeout
+        self.server._wheel.add(self)
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.server._connected(self)
+
+    def buffer_updated(self, nbytes: int):
+        if self._relay is None:
+            super().buffer_updated(nbytes)
+        else:
+            self._relay.write(
+                self._read_buffer[self._read_end : self._read_end + nbytes]
+            )
+
+    def pause_writing(self):
+        super().pause_writing()
+        if self._relay is not None:
+            self._relay.pause_reading()
+
+    def resume_writing(self):
+        super().resume_writing()
+        if self._relay is not None:
+            self._relay.resume_reading()
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self._relay is not None:
+            self._relay.close()
+        self.server._disconnected(self)
 
     async def _handshake(self):
         try:
@@ -25,27 +175,149 @@ class Connection(ConnectionBase):
         except DataException:
             raise DataException("Invalid handshake request")
         else:
-            version = response["go"]
+            version, *options = (response["go"] or "").split() or [None]
 
         if version != __version__:
             await self.send("no")
+            raise VersionException(f"Client version {version!r} is not supported")
+        elif BINARY_OPTION in options:
+            await self.send("ok", f"{version} {BINARY_OPTION}")
+            self.binary = True
         else:
             await self.send("ok", version)
 
-    async def _setup(self):
-        await self.send("mode", self.server.mode)
-        await self.send(
-            "stones", (self.server.game_state.stones, self.server.game_state.board_size)
+    async def _join(self) -> Tuple[str, bool]:
+        # Receives the id of the room the client joins,
+        # and whether it joins as a spectator
+        response = await self.recv("join", "watch")
+        watch = "watch" in response
+        room_id = response["watch" if watch else "join"]
+        if not room_id or len(room_id) > MAX_ROOM_ID_LENGTH:
+            raise DataException(f"Invalid room {room_id!r}")
+        return room_id, watch
+
+    async def _accept_forward(self) -> Tuple[str, bool]:
+        # Receives the framing and room of a client that has joined the room
+        # on another worker, see _join
+        self.binary, watch, room_id = (await self.recv("forward"))["forward"]
+        if len(room_id) > MAX_ROOM_ID_LENGTH:
+            raise DataException(f"Invalid room {room_id!r}")
+        return room_id, watch
+
+    async def _forward(self, worker: int, room_id: str, watch: bool):
+        # Relays the rest of the connection to the worker owning the room,
+        # including any data already received
+        transport, _ = await asyncio.get_running_loop().create_connection(
+            lambda: Relay(self), INTERNAL_HOST, self.server.internal_port + worker
         )
+        transport.write(serialize("forward", (self.binary, watch, room_id)))
+        transport.write(self._read_buffer[self._read_start : self._read_end])
+        self._read_start = self._read_end
+        self._relay = transport
+        self.resume_reading("buffer")
+
+    async def _setup(self, room_id: str, watch: bool):
+        try:
+            room = self.server.room(room_id)
+        except ServerFullException:
+            await self.send("full")
+            raise
+        if watch:
+            room.watch(self)
+            color = None
+        else:
+            color = room.seat(self)
+            if color is None:
+                await self.send("full")
+                raise ServerFullException(f"{room} is full")
+        self.room, self.color = room, color
+
+        self.queue("mode", room.mode)
+        if room.mode == Mode.NORMAL and not watch:
+            self.queue("color", color)
+        await self.flush()
+
+        # Sends the moves the client is missing, or the whole board
+        # if they are not available, and then the moves played since,
+        # which are held until the setup is complete
+        sync = (await self.recv("sync"))["sync"]
+        messages = None
+        if sync is not None and sync[0] == room.game:
+            messages = room.log.since(sync[1])
+        if messages is None:
+            game_state = room.game_state
+            messages = [("stones", (game_state.stones, game_state.board_size))]
+        self._held.clear()
+        await self.send_many(messages + [("seq", (room.game, room.log.seq))])
         await self.recv("ack")
-        await self.send("ready")
+        self.queue("ready")
+        self.queue_data(self._held)
+        self._held.clear()
+        if room.to_play() is self:
+            self.queue("yourturn", room.game_state.current_color)
+        self.server._established(self)
+        await self.flush()
+
+    async def _read_messages(self):
+        # Passes the moves requested by the client to its room, until it closes
+        # the connection. Reading from the client is paused while waiting
+        # for space in the room's queue, so a client requesting moves faster
+        # than they can be played is held back by its socket, and clients
+        # sending messages faster than the server's rate limit are paused
+        loop = asyncio.get_running_loop()
+        server = self.server
+        rate_limit = (
+            TokenBucket(server.message_rate, server.message_burst)
+            if server.message_rate is not None
+            else None
+        )
+        while True:
+            response = await self.recv("place", "close")
+            delay = rate_limit.take(loop.time()) if rate_limit else 0
+            if delay:
+                self.pause_reading("rate")
+                await asyncio.sleep(delay)
+                self.resume_reading("rate")
+
+            if "close" in response:
+                await self.close()
+                return
+
+            pos = response["place"]
+            if not isinstance(pos, Position):
+                raise DataException(f"Expected a position, got {pos!r}")
+            try:
+                self.room.inbound.put_nowait((self, pos))
+            except asyncio.QueueFull:
+                # Stops reading from the client until there is space
+                self.pause_reading("inbound")
+                try:
+                    await self.room.inbound.put((self, pos))
+                finally:
+                    self.resume_reading("inbound")
 
     async def serve(self):
         """
         Serves the connection to the client
         """
-        await self._handshake()
-        await self._setup()
+        self._start_phase(self.server.handshake_timeout)
+        if self.forwarded:
+            room_id, watch = await self._accept_forward()
+        else:
+            await self._handshake()
+            self._start_phase(self.server.setup_timeout)
+            room_id, watch = await self._join()
+            worker = self.server.owner(room_id)
+            if worker != self.server.worker:
+                await self._forward(worker, room_id, watch)
+                # Only pending on the worker relayed to
+                self.server._pending.discard(self.id)
+                return
+
+        if self.forwarded:
+            self._start_phase(self.server.setup_timeout)
+        await self._setup(room_id, watch)
+        await self._read_messages()
 
 
 class Server(ClientServerBase):
@@ -53,34 +325,378 @@ class Server(ClientServerBase):
     Represents the server
     """
 
-    def __init__(self, board_size, host=None, port=None, *, mode):
+    def __init__(
+        self,
+        board_size,
+        host=None,
+        port=None,
+        *,
+        mode,
+        worker=0,
+        workers=1,
+        internal_port=None,
+        high_water=DEFAULT_HIGH_WATER,
+        handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT,
+        setup_timeout=DEFAULT_SETUP_TIMEOUT,
+        idle_timeout=None,
+        max_pending=DEFAULT_MAX_PENDING,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        max_rooms=DEFAULT_MAX_ROOMS,
+        message_rate=DEFAULT_MESSAGE_RATE,
+        message_burst=DEFAULT_MESSAGE_BURST,
+        journal_dir=None,
+        recovery_grace=DEFAULT_RECOVERY_GRACE,
+    ):
+        """
+        Instantiates the server. With several workers, this is one of them,
+        see serve_workers
+
+        ``high_water`` is the number of bytes a client may have waiting to be sent
+        before it is disconnected for not keeping up with broadcasts.
+        Clients are disconnected if they do not complete the handshake
+        within ``handshake_timeout`` seconds of connecting, or the setup
+        within ``setup_timeout`` seconds of that, or, if ``idle_timeout``
+        is not None, if they send nothing for that many seconds after.
+        At most ``max_connections`` clients may be connected, of which at most
+        ``max_pending`` may not have completed the setup, and at most ``max_rooms``
+        rooms may be open, with further clients sent ``full``.
+        Clients sending more than ``message_rate`` messages per second,
+        after a burst of ``message_burst``, are paused, unless it is None.
+        If ``journal_dir`` is not None, the moves of each room are journaled
+        in that directory, and the games are recovered from it when serving.
+        A recovered room still empty after ``recovery_grace`` seconds is closed
+        """
         super().__init__(host if host else DEFAULT_HOST, port=port)
+        self.board_size = board_size
         self.mode = mode
-        self.game_state = GameState(board_size)
-        self._connections = []
+        self.rooms: Dict[str, Room] = {}
+        self._connections: Dict[int, Connection] = {}
+        self._connection_ids = count()
 
-    async def _connected(self, reader, writer):
-        connection = Connection(self, reader, writer)
-        self._connections += [connection]
-        await connection.serve()
+        self.worker = worker
+        self.workers = workers
+        self.internal_port = internal_port if internal_port else DEFAULT_INTERNAL_PORT
+        self._ring = HashRing(workers)
+        self._internal_server = None
+        self.high_water = high_water
+        self.handshake_timeout = handshake_timeout
+        self.setup_timeout = setup_timeout
+        self.idle_timeout = idle_timeout
+        self.max_pending = max_pending
+        self.max_connections = max_connections
+        self.max_rooms = max_rooms
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        # Ids of the connections yet to complete the setup,
+        # and the wheel expiring connections that take too long
+        self._pending: Set[int] = set()
+        self._wheel = TimerWheel()
+        self.journal = Journal(journal_dir) if journal_dir is not None else None
+        self.recovery_grace = recovery_grace
+
+    def owner(self, room_id: str) -> int:
+        """
+        The worker owning the room with the given id
+        """
+        return self._ring.node(room_id) if self.workers > 1 else self.worker
+
+    def room(self, room_id: str) -> Room:
+        """
+        The room with the given id, which is opened if it does not exist
+
+        Raises ServerFullException if the room would be opened,
+        but the maximum number of rooms are open
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
+            if len(self.rooms) >= self.max_rooms:
+                raise ServerFullException("Too many rooms are open")
+            room = self._open_room(room_id, self.board_size, self.mode)
+            if self.journal is not None:
+                self.journal.create(
+                    room_id, room.game_state.board_size, self.mode, room.game
+                )
+        return room
+
+    def _open_room(self, room_id: str, board_size: int, mode: Mode) -> Room:
+        room = self.rooms[room_id] = Room(room_id, board_size, mode)
+        room.task = asyncio.create_task(self._run_room(room))
+        return room
+
+    def close_room(self, room_id: str):
+        """
+        Closes the room with the given id, discarding its game
+        """
+        room = self.rooms.pop(room_id, None)
+        if room is not None:
+            if room.task is not None:
+                room.task.cancel()
+            if self.journal is not None:
+                self.journal.remove(room_id)
+
+    def recover(self) -> int:
+        """
+        Reopens the rooms owned by this worker from their journals,
+        replaying the moves of each game, returning the number of rooms reopened
+
+        Each game is restored from its latest snapshot, if any, and only
+        the moves since are replayed, up to the first move that cannot be played,
+        so that a journal left partly written is recovered as far as possible.
+        The journal is then truncated after the moves replayed.
+        Rooms no client has joined within the grace period are closed
+        """
+        recovered = []
+        for game in self.journal.games(
+            lambda room_id: self.owner(room_id) == self.worker
+        ):
+            if game.room_id in self.rooms:
+                continue
+            room = self._open_room(game.room_id, game.board_size, game.mode)
+            room.game = game.game
+            if game.snapshot is not None:
+                seq, game_state = game.snapshot
+                room.restore(game_state, seq)
+            seq = replay(
+                game.entries, lambda pos: room.play(pos)[0][1].color, room.log.seq
+            )
+            self.journal.truncate(room.id, seq, keep_snapshot=game.snapshot is not None)
+            recovered += [room]
+
+        asyncio.get_running_loop().call_later(
+            self.recovery_grace, self._close_abandoned, recovered
+        )
+        return len(recovered)
+
+    def _close_abandoned(self, rooms: List[Room]):
+        # Closes the recovered rooms no client has joined since,
+        # as rooms are otherwise only closed when their last client leaves
+        for room in rooms:
+            if room.empty and self.rooms.get(room.id) is room:
+                self.close_room(room.id)
+
+    async def _run_room(self, room: Room):
+        # Plays the moves requested in the room one at a time, in order,
+        # sending each to every client in the room, and the next turn
+        # to the player whose turn it is, unless they are yet to complete
+        # the setup, which sends it. Moves requested by clients
+        # whose turn it is not are ignored, and illegal moves are retried
+        while True:
+            connection, pos = await room.inbound.get()
+            if connection is not room.to_play():
+                continue
+
+            try:
+                messages = room.play(pos)
+            except IllegalMoveException:
+                pass
+            else:
+                self.broadcast(room, messages)
+                if self.journal is not None:
+                    stone = messages[0][1]
+                    self.journal.append(room.id, room.log.seq, stone.color, stone.pos)
+                    if room.log.seq % self.journal.snapshot_interval == 0:
+                        self.journal.snapshot(room.id, room.log.seq, room.game_state)
+            connection = room.to_play()
+            if connection is not None and connection.established:
+                connection.queue("yourturn", room.game_state.current_color)
+
+    def broadcast(self, room: Room, messages: List[Tuple[str, Any]]):
+        """
+        Sends messages, as pairs of key and value, to every player and spectator
+        in the room, without waiting for them to be sent
+
+        The messages are serialized once for each framing in use, and clients
+        with more than ``high_water`` bytes waiting to be sent are disconnected,
+        so that slow clients cannot hold up the game. Messages to clients
+        yet to complete the setup are held until they do, see Connection.hold
+        """
+        data = {}
+        for connection in list(room.subscribers):
+            if connection.write_buffer_size > self.high_water:
+                connection.abort()
+                continue
+
+            binary = connection.binary
+            if binary not in data:
+                data[binary] = b"".join(
+                    serialize(key, value, binary) for key, value in messages
+                )
+            if connection.established:
+                connection.queue_data(data[binary])
+            else:
+                connection.hold(data[binary])
+
+    def _connected(self, connection):
+        if (
+            len(self._connections) >= self.max_connections
+            or len(self._pending) >= self.max_pending
+        ):
+            connection.reject()
+            return
+
+        connection.id = next(self._connection_ids)
+        self._connections[connection.id] = connection
+        self._pending.add(connection.id)
+        connection.task = asyncio.create_task(self._serve(connection))
+
+    def _established(self, connection):
+        # Marks the connection as having completed the setup
+        connection.established = True
+        self._pending.discard(connection.id)
+        self._wheel.add(connection)
+
+    def _disconnected(self, connection):
+        # Forgets the connection, frees its seat,
+        # and closes its room once it is empty
+        self._connections.pop(connection.id, None)
+        self._pending.discard(connection.id)
+        self._wheel.discard(connection)
+        room = connection.room
+        if room is not None:
+            room.leave(connection)
+            if room.empty and self.rooms.get(room.id) is room:
+                self.close_room(room.id)
+
+    async def _serve(self, connection):
+        try:
+            await connection.serve()
+        except ConnectionException:
+            await connection.close()
 
     async def serve(self):
         """
-        Opens the server for listening
+        Opens the server for listening, after recovering any journaled games
+
+        With several workers, the port is shared between them,
+        and each also listens on its internal port for connections
+        forwarded from the others
         """
-        self.server = await asyncio.start_server(self._connected, self.host, self.port)
+        loop = asyncio.get_running_loop()
+        if self.journal is not None:
+            self.recover()
+            self.journal.start()
+        self._wheel.start()
+        if self.workers > 1:
+            self._internal_server = await loop.create_server(
+                lambda: Connection(self, forwarded=True),
+                INTERNAL_HOST,
+                self.internal_port + self.worker,
+            )
+        self.server = await loop.create_server(
+            lambda: Connection(self),
+            self.host,
+            self.port,
+            reuse_port=True if self.workers > 1 else None,
+        )
         async with self.server:
             await self.server.serve_forever()
 
     async def close(self):
         """
         Closes the server and its connections
+
+        Journals are kept, so the games open are recovered when serving again
         """
-        for connection in self._connections:
+        self._wheel.stop()
+        for room in self.rooms.values():
+            room.task.cancel()
+        self.rooms.clear()
+        if self.journal is not None:
+            await self.journal.close()
+        for connection in list(self._connections.values()):
             await connection.close()
 
-        self.server.close()
-        await self.server.wait_closed()
+        for server in (self.server, self._internal_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+
+
+def _run_worker(
+    board_size, host, port, mode, worker, workers, internal_port, journal_dir
+):
+    # Runs a single worker of serve_workers in its process,
+    # which is terminated by SIGTERM, rather than the handler of the parent
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    server = Server(
+        board_size,
+        host,
+        port,
+        mode=mode,
+        worker=worker,
+        workers=workers,
+        internal_port=internal_port,
+        journal_dir=journal_dir,
+    )
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_workers(
+    board_size,
+    host=None,
+    port=None,
+    *,
+    mode,
+    workers: Optional[int] = None,
+    internal_port=None,
+    journal_dir=None,
+):
+    """
+    Runs the server in several processes, one per CPU by default,
+    all listening on the same port, blocking until they exit
+
+    The kernel spreads incoming connections between the workers (SO_REUSEPORT,
+    so this needs a platform supporting it). Each room is owned by a single
+    worker, by consistent hashing of its id, and a client joining a room owned
+    by another worker is relayed to it, so each game is only ever played
+    in one process. Worker ``i`` listens for relayed clients on
+    ``internal_port + i`` on the loopback interface. The workers may share
+    ``journal_dir``, as each only recovers the rooms it owns
+
+    The workers are terminated when this returns, including when the process
+    receives SIGTERM, so this must be called from the main thread
+    """
+    workers = workers if workers else os.cpu_count() or 1
+    processes = [
+        multiprocessing.Process(
+            target=_run_worker,
+            args=(
+                board_size,
+                host,
+                port,
+                mode,
+                worker,
+                workers,
+                internal_port,
+                journal_dir,
+            ),
+            daemon=True,
+        )
+        for worker in range(workers)
+    ]
+
+    def terminate(signum, frame):
+        # Exits through the finally below, as SIGTERM would otherwise
+        # end the process without terminating the workers
+        raise SystemExit(128 + signum)
+
+    previous_handler = signal.signal(signal.SIGTERM, terminate)
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.pid is not None:
+                process.terminate()
+        for process in processes:
+            if process.pid is not None:
+                process.join()
+        signal.signal(signal.SIGTERM, previous_handler)
 
 
 if __name__ == "__main__":